@@ -0,0 +1,192 @@
+"""Bootstrap confidence intervals of aggregate metrics
+
+all replicates are drawn at once as resampling counts (how often each
+pair, or each subject with all of its pairs, is drawn in a replicate),
+so the means and pearson correlations of the replicates are weighted
+sums computed with one matrix product per chunk of replicates instead
+of a python loop over the replicates
+"""
+
+from __future__ import annotations
+
+__all__ = [
+    "ConfidenceInterval",
+    "bootstrap_correlations",
+    "bootstrap_means",
+    "correlation_confidence_interval",
+    "mean_confidence_intervals",
+]
+
+import builtins
+import dataclasses
+import typing
+
+import numpy as np
+
+# at most this many (replicate, pair) weights are held at once
+_MAX_CHUNK_ELEMENTS = 2**22
+
+
+@dataclasses.dataclass(frozen=True)
+class ConfidenceInterval:
+    estimate: builtins.float
+    lower: builtins.float
+    upper: builtins.float
+    confidence: builtins.float
+
+    @classmethod
+    def from_replicates(
+        cls,
+        estimate: builtins.float,
+        replicates: np.ndarray,
+        confidence: builtins.float = 0.95,
+    ) -> ConfidenceInterval:
+        """percentile interval of the bootstrap replicates of a statistic
+        (replicates where the statistic is undefined, i.e. NaN, are ignored)"""
+        if not 0.0 < confidence < 1.0:
+            raise ValueError(f"confidence must be in (0, 1). Got {confidence}.")
+        alpha = 100.0 * (1.0 - confidence) / 2.0
+        if np.isnan(replicates).all():
+            lower = upper = float("nan")
+        else:
+            bounds = np.nanpercentile(replicates, [alpha, 100.0 - alpha])
+            lower, upper = bounds.tolist()
+        return cls(float(estimate), lower, upper, confidence)
+
+
+def _replicate_weights(
+    n: builtins.int,
+    n_replicates: builtins.int,
+    *,
+    groups: typing.Optional[typing.Sequence[typing.Hashable]] = None,
+    seed: typing.Optional[builtins.int] = 0,
+) -> typing.Iterator[np.ndarray]:
+    """chunks of the (replicates x n) matrix of how often each item is drawn,
+    resampling the groups (with all their items) if `groups` is given"""
+    if n_replicates < 1:
+        raise ValueError(f"n_replicates must be positive. Got {n_replicates}.")
+    if groups is None:
+        inverse = np.arange(n)
+    else:
+        if len(groups) != n:
+            raise ValueError(f"Expected {n} group labels. Got {len(groups)}.")
+        _, inverse = np.unique(np.asarray(groups, dtype=object), return_inverse=True)
+    n_groups = int(inverse.max()) + 1 if n else 0
+    rng = np.random.default_rng(seed)
+    chunk_size = max(_MAX_CHUNK_ELEMENTS // max(n, 1), 1)
+    for start in range(0, n_replicates, chunk_size):
+        size = min(chunk_size, n_replicates - start)
+        draws = rng.integers(n_groups, size=(size, n_groups))
+        # counts of each group per replicate in one bincount of offset draws
+        draws += np.arange(size)[:, np.newaxis] * n_groups
+        counts = np.bincount(draws.ravel(), minlength=size * n_groups)
+        counts = counts.reshape(size, n_groups)
+        yield counts[:, inverse].astype(np.float64)
+
+
+def bootstrap_means(
+    values: typing.Union[np.ndarray, typing.Sequence[builtins.float]],
+    *,
+    n_replicates: builtins.int = 10_000,
+    groups: typing.Optional[typing.Sequence[typing.Hashable]] = None,
+    seed: typing.Optional[builtins.int] = 0,
+) -> np.ndarray:
+    """(replicates x columns) bootstrap replicates of the mean of each column
+    of `values` (one row per pair), ignoring NaNs like `np.nanmean`"""
+    data = np.asarray(values, dtype=np.float64)
+    data = data.reshape(len(data), -1)
+    finite = np.isfinite(data)
+    columns = np.concatenate([np.where(finite, data, 0.0), finite], axis=1)
+    weights = _replicate_weights(len(data), n_replicates, groups=groups, seed=seed)
+    totals = np.concatenate([w @ columns for w in weights])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means: np.ndarray = totals[:, : data.shape[1]] / totals[:, data.shape[1] :]
+    return means
+
+
+def _correlation_moments(
+    x: typing.Union[np.ndarray, typing.Sequence[builtins.float]],
+    y: typing.Union[np.ndarray, typing.Sequence[builtins.float]],
+) -> np.ndarray:
+    """(pairs x 6) terms whose weighted sums are the count, sums and
+    (co-)moments of the finite pairs of x and y"""
+    xs = np.asarray(x, dtype=np.float64)
+    ys = np.asarray(y, dtype=np.float64)
+    if xs.shape != ys.shape or xs.ndim != 1:
+        raise ValueError("x and y must be 1D and of equal length.")
+    finite = np.isfinite(xs) & np.isfinite(ys)
+    # centering first avoids cancellation in the moment differences
+    if finite.any():
+        xs = np.where(finite, xs - xs[finite].mean(), 0.0)
+        ys = np.where(finite, ys - ys[finite].mean(), 0.0)
+    mask = finite.astype(np.float64)
+    return np.stack([mask, xs, ys, xs * xs, ys * ys, xs * ys], axis=1)
+
+
+def _correlations(moments: np.ndarray) -> np.ndarray:
+    n, sx, sy, sxx, syy, sxy = moments.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = sxy - sx * sy / n
+        var_x = sxx - sx * sx / n
+        var_y = syy - sy * sy / n
+        denom = np.sqrt(var_x * var_y)
+        correlations: np.ndarray = np.where(denom > 0.0, cov / denom, np.nan)
+    return correlations
+
+
+def bootstrap_correlations(
+    x: typing.Union[np.ndarray, typing.Sequence[builtins.float]],
+    y: typing.Union[np.ndarray, typing.Sequence[builtins.float]],
+    *,
+    n_replicates: builtins.int = 10_000,
+    groups: typing.Optional[typing.Sequence[typing.Hashable]] = None,
+    seed: typing.Optional[builtins.int] = 0,
+) -> np.ndarray:
+    """bootstrap replicates of the pearson correlation of x and y computed
+    from weighted (co-)moments; pairs where x or y is NaN are ignored"""
+    columns = _correlation_moments(x, y)
+    weights = _replicate_weights(len(columns), n_replicates, groups=groups, seed=seed)
+    return _correlations(np.concatenate([w @ columns for w in weights]))
+
+
+def mean_confidence_intervals(
+    values: typing.Union[np.ndarray, typing.Sequence[builtins.float]],
+    *,
+    confidence: builtins.float = 0.95,
+    n_replicates: builtins.int = 10_000,
+    groups: typing.Optional[typing.Sequence[typing.Hashable]] = None,
+    seed: typing.Optional[builtins.int] = 0,
+) -> typing.List[ConfidenceInterval]:
+    """bootstrap confidence interval of the mean of each column of `values`
+    (one row per pair); with `groups` (e.g., a subject id per pair), the
+    groups are resampled so the pairs of a group are drawn together"""
+    data = np.asarray(values, dtype=np.float64)
+    data = data.reshape(len(data), -1)
+    replicates = bootstrap_means(
+        data, n_replicates=n_replicates, groups=groups, seed=seed
+    )
+    finite = np.isfinite(data)
+    with np.errstate(invalid="ignore"):
+        estimates = np.where(finite, data, 0.0).sum(axis=0) / finite.sum(axis=0)
+    return [
+        ConfidenceInterval.from_replicates(estimate, replicates[:, i], confidence)
+        for i, estimate in enumerate(estimates.tolist())
+    ]
+
+
+def correlation_confidence_interval(
+    x: typing.Union[np.ndarray, typing.Sequence[builtins.float]],
+    y: typing.Union[np.ndarray, typing.Sequence[builtins.float]],
+    *,
+    confidence: builtins.float = 0.95,
+    n_replicates: builtins.int = 10_000,
+    groups: typing.Optional[typing.Sequence[typing.Hashable]] = None,
+    seed: typing.Optional[builtins.int] = 0,
+) -> ConfidenceInterval:
+    """bootstrap confidence interval of the pearson correlation of x and y
+    (e.g., the predicted and true lesion volumes of each pair)"""
+    replicates = bootstrap_correlations(
+        x, y, n_replicates=n_replicates, groups=groups, seed=seed
+    )
+    (estimate,) = _correlations(_correlation_moments(x, y).sum(axis=0, keepdims=True))
+    return ConfidenceInterval.from_replicates(estimate, replicates, confidence)
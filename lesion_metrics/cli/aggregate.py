@@ -1,8 +1,16 @@
 """Console script for lesion_metrics."""
 import argparse
 import builtins
+import concurrent.futures
+import contextlib
+import dataclasses
+import hashlib
+import itertools
+import json
 import logging
+import os
 import pathlib
+import re
 import sys
 import typing
 import warnings
@@ -11,11 +19,38 @@ with warnings.catch_warnings():
     warnings.filterwarnings("ignore", category=FutureWarning)
     warnings.filterwarnings("ignore", category=UserWarning)
     import medio.image as mioi
+    import numpy as np
     import pandas as pd
 
+    import lesion_metrics.bootstrap as lmb
+    import lesion_metrics.cli.cache as lmcca
     import lesion_metrics.cli.common as lmcc
-    import lesion_metrics.metrics as lmm
-    import lesion_metrics.volume as lmv
+    import lesion_metrics.cli.merge as lmcm
+    import lesion_metrics.context as lmc
+    import lesion_metrics.typing as lmt
+
+
+# output column of each metric (see `lesion_metrics.context.METRICS`);
+# the order is the order of the columns in the output
+COLUMNS = {
+    "dice": "Dice",
+    "jaccard": "Jaccard",
+    "ppv": "PPV",
+    "tpr": "TPR",
+    "lfdr": "LFDR",
+    "ltpr": "LTPR",
+    "avd": "AVD",
+    "isbi15_score": "ISBI15 Score",
+    "pred_volume": "Pred. Vol.",
+    "truth_volume": "Truth. Vol.",
+    "pred_count": "Pred. Count",
+    "truth_count": "Truth. Count",
+    "assd": "ASSD",
+    "hausdorff_distance": "HD",
+    "hd95": "HD95",
+}
+DEFAULT_METRICS = list(COLUMNS)[:12]
+CORRELATIONS = ["Vol. Correlation", "Count Correlation"]
 
 
 def arg_parser() -> argparse.ArgumentParser:
@@ -23,15 +58,22 @@ def arg_parser() -> argparse.ArgumentParser:
         "Calculate a suite of lesion quality metrics "
         "for a set of NIfTI binary (lesion) segmentations."
     )
-    parser = argparse.ArgumentParser(description=desc)
+    epilog = (
+        "partial results of runs with --shard are combined with "
+        "`lesion-metrics merge` (see `lesion-metrics merge --help`)"
+    )
+    parser = argparse.ArgumentParser(description=desc, epilog=epilog)
 
     required = parser.add_argument_group("Required")
     required.add_argument(
         "-o",
         "--out-file",
-        type=lmcc.csv_file_path(),
+        type=lmcc.table_file_path(),
         required=True,
-        help="path to output csv file of results",
+        help=(
+            "path to output csv (or, if it ends with .jsonl, json lines) file "
+            "of results, written as each pair is evaluated"
+        ),
     )
 
     primary = parser.add_argument_group("Primary Input (provide these instead of -f)")
@@ -61,7 +103,62 @@ def arg_parser() -> argparse.ArgumentParser:
         help=(
             "path to input csv file with (at least) two columns named "
             "`pred` and `truth` consisting of paths to prediction and "
-            "corresponding truth images"
+            "corresponding truth images (and, optionally, a `subject` column "
+            "for --bootstrap)"
+        ),
+    )
+
+    pairing = parser.add_argument_group("Pairing (with -p & -t)")
+    pairing.add_argument(
+        "--pairing",
+        type=str,
+        choices=["order", "stem"],
+        default="order",
+        help=(
+            "pair the sorted images of the two directories by position (order) "
+            "or by their normalized file name stems (stem); with stem, an "
+            "image without a counterpart is skipped (with a warning) instead "
+            "of misaligning all later pairs"
+        ),
+    )
+    pairing.add_argument(
+        "-r",
+        "--recursive",
+        action="store_true",
+        help="also find images in subdirectories (e.g., BIDS-like layouts)",
+    )
+    pairing.add_argument(
+        "--pred-prefix",
+        type=str,
+        default="",
+        help="prefix removed from the prediction stems (with --pairing stem)",
+    )
+    pairing.add_argument(
+        "--pred-suffix",
+        type=str,
+        default="",
+        help="suffix removed from the prediction stems (with --pairing stem)",
+    )
+    pairing.add_argument(
+        "--truth-prefix",
+        type=str,
+        default="",
+        help="prefix removed from the truth stems (with --pairing stem)",
+    )
+    pairing.add_argument(
+        "--truth-suffix",
+        type=str,
+        default="",
+        help="suffix removed from the truth stems (with --pairing stem)",
+    )
+    pairing.add_argument(
+        "--stem-pattern",
+        type=str,
+        default=None,
+        help=(
+            "regular expression whose first group (or match) in the stems "
+            "(after removing the prefixes/suffixes) is the key the images are "
+            "paired by; images it does not match are ignored (with --pairing stem)"
         ),
     )
 
@@ -72,12 +169,156 @@ def arg_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="output the volume correlation of the set of images",
     )
+    options.add_argument(
+        "-m",
+        "--metrics",
+        type=str,
+        nargs="+",
+        choices=list(COLUMNS),
+        default=DEFAULT_METRICS,
+        help=(
+            "metrics to compute (default: all but the surface distances); "
+            "intermediates only needed by other metrics (e.g., the connected "
+            "components for a dice-only evaluation) are skipped"
+        ),
+    )
     options.add_argument(
         "-it",
         "--iou-threshold",
         type=float,
-        default=0.0,
-        help="iou threshold for detection (in LTPR and LFDR)",
+        nargs="+",
+        default=[0.0],
+        help=(
+            "iou threshold(s) for detection (in LTPR and LFDR); the first "
+            "is used for the LTPR, LFDR and ISBI15 columns and, if more than "
+            "one threshold is given, an LTPR and LFDR column is added per threshold"
+        ),
+    )
+    options.add_argument(
+        "-itr",
+        "--iou-threshold-range",
+        type=float,
+        nargs=3,
+        default=None,
+        metavar=("START", "STOP", "NUM"),
+        help=(
+            "add NUM evenly spaced iou thresholds from START to STOP "
+            "(inclusive) to the thresholds in --iou-threshold"
+        ),
+    )
+    options.add_argument(
+        "-sdt",
+        "--surface-dice-tolerance",
+        type=float,
+        nargs="+",
+        default=None,
+        help=(
+            "add a normalized surface dice column for each tolerance "
+            "(in the physical units of the truth image, e.g., mm)"
+        ),
+    )
+    options.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help=(
+            "number of worker processes evaluating pairs in parallel "
+            "(0 uses one per cpu); the output does not depend on it"
+        ),
+    )
+    options.add_argument(
+        "-pf",
+        "--prefetch",
+        type=int,
+        default=2,
+        help=(
+            "number of pairs (per process) loaded ahead in background threads "
+            "while the current pair is evaluated (0 disables prefetching)"
+        ),
+    )
+    options.add_argument(
+        "-pm",
+        "--prefetch-memory",
+        type=float,
+        default=2048.0,
+        help=(
+            "memory budget (in MiB, per process) for the loaded images; "
+            "fewer pairs are loaded ahead if they would exceed it"
+        ),
+    )
+    options.add_argument(
+        "--cache",
+        type=pathlib.Path,
+        default=None,
+        help=(
+            "path to an (sqlite) result cache; pairs whose files and evaluation "
+            "parameters are unchanged since a previous run are not re-evaluated"
+        ),
+    )
+    options.add_argument(
+        "--cache-content-hash",
+        action="store_true",
+        help="key the cache by file content hash instead of size and mtime",
+    )
+    options.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=50,
+        help="commit newly evaluated pairs to the cache every this many pairs",
+    )
+    options.add_argument(
+        "--shard",
+        type=lmcc.shard_spec(),
+        default=None,
+        metavar="i/N",
+        help=(
+            "only evaluate the i-th (from 0) of N contiguous, equally sized "
+            "parts of the pair list and write a partial result (rows without "
+            "the summary, plus a .state.json file next to it) for "
+            "`lesion-metrics merge`"
+        ),
+    )
+    options.add_argument(
+        "-b",
+        "--bootstrap",
+        type=int,
+        default=None,
+        metavar="B",
+        help=(
+            "add rows with the bootstrap confidence interval (from B replicates) "
+            "of the mean of each column and of the correlations (NaN for a "
+            "column with a NaN, like the summary rows)"
+        ),
+    )
+    options.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="confidence level of the --bootstrap intervals",
+    )
+    options.add_argument(
+        "--subject-pattern",
+        type=str,
+        default=None,
+        help=(
+            "regular expression whose first group (or match) in the truth file "
+            "name is the subject; the subjects (with all their scans) instead of "
+            "the pairs are resampled in --bootstrap (a `subject` column in "
+            "--in-file does the same)"
+        ),
+    )
+    options.add_argument(
+        "-qs",
+        "--quantile-sketch",
+        type=int,
+        default=None,
+        metavar="K",
+        help=(
+            "estimate the percentiles in the summary rows with a quantile sketch "
+            "of size K (rank error about 1.7/K) instead of keeping every value, "
+            "so memory does not grow with the number of pairs"
+        ),
     )
     options.add_argument(
         "-v",
@@ -89,8 +330,225 @@ def arg_parser() -> argparse.ArgumentParser:
     return parser
 
 
+def _iou_thresholds(
+    args: argparse.Namespace,
+) -> typing.List[builtins.float]:
+    """unique iou thresholds in the order given on the command line"""
+    thresholds = list(args.iou_threshold)
+    if args.iou_threshold_range is not None:
+        start, stop, num = args.iou_threshold_range
+        if num < 1 or num != int(num):
+            raise ValueError("NUM in --iou-threshold-range must be a positive integer.")
+        thresholds.extend(np.linspace(start, stop, int(num)).round(6).tolist())
+    thresholds = list(dict.fromkeys(thresholds))
+    if not all(0.0 <= thresh <= 1.0 for thresh in thresholds):
+        raise ValueError(f"IoU thresholds must be in [0, 1]. Got {thresholds}.")
+    return thresholds
+
+
+@dataclasses.dataclass(frozen=True)
+class _PairResult:
+    values: typing.Dict[builtins.str, builtins.float]
+    lfdr_curve: typing.Optional[typing.List[builtins.float]]
+    ltpr_curve: typing.Optional[typing.List[builtins.float]]
+    surface_dice: typing.List[builtins.float]
+
+    @classmethod
+    def from_dict(
+        cls, data: typing.Optional[typing.Dict[builtins.str, typing.Any]]
+    ) -> typing.Optional["_PairResult"]:
+        return None if data is None else cls(**data)
+
+
+def _merge_cached(
+    cache: lmcca.ResultCache,
+    keys: typing.List[builtins.str],
+    hits: typing.List[typing.Optional[_PairResult]],
+    fresh: typing.Iterator[_PairResult],
+) -> typing.Iterator[_PairResult]:
+    """results of all pairs in order from the cache hits and, for the
+    misses, the freshly evaluated results (which are added to the cache)"""
+    for key, hit in zip(keys, hits):
+        if hit is not None:
+            yield hit
+            continue
+        result = next(fresh)
+        cache.put(key, dataclasses.asdict(result))
+        yield result
+
+
+@dataclasses.dataclass(frozen=True)
+class _PairEvaluation:
+    """evaluate pairs of image files (picklable for worker processes)"""
+
+    metrics: typing.List[builtins.str]
+    iou_thresholds: typing.List[builtins.float]
+    tolerances: typing.List[builtins.float]
+    prefetch: builtins.int = 0
+    prefetch_bytes: typing.Optional[builtins.int] = None
+
+    @staticmethod
+    def load(
+        pair: typing.Tuple[pathlib.Path, pathlib.Path]
+    ) -> typing.Tuple[lmt.Label, lmt.Label]:
+        pred_fn, truth_fn = pair
+        pred = mioi.Image.from_path(pred_fn)
+        truth = mioi.Image.from_path(truth_fn)
+        return pred, truth
+
+    def evaluate(self, pred: lmt.Label, truth: lmt.Label) -> _PairResult:
+        # squeezed here (not on load) to keep the spacing of the kept axes
+        context = lmc.PairContext.from_images(pred, truth)
+        values = context.evaluate(self.metrics, iou_threshold=self.iou_thresholds[0])
+        lfdr_curve = ltpr_curve = None
+        if len(self.iou_thresholds) > 1:
+            if "lfdr" in self.metrics:
+                lfdr_curve = context.overlap.lfdr_curve(self.iou_thresholds).tolist()
+            if "ltpr" in self.metrics:
+                ltpr_curve = context.overlap.ltpr_curve(self.iou_thresholds).tolist()
+        surface_dice: typing.List[builtins.float] = []
+        if self.tolerances:
+            distances = context.surface_distances
+            surface_dice = distances.surface_dice(self.tolerances).tolist()
+        return _PairResult(values, lfdr_curve, ltpr_curve, surface_dice)
+
+    def __call__(
+        self, pairs: typing.Iterable[typing.Tuple[pathlib.Path, pathlib.Path]]
+    ) -> typing.Iterator[_PairResult]:
+        """evaluate the pairs in order while the next ones are loaded"""
+        images = lmcc.prefetch(
+            self.load, pairs, depth=self.prefetch, max_bytes=self.prefetch_bytes
+        )
+        for pred, truth in images:
+            yield self.evaluate(pred, truth)
+
+    def evaluate_chunk(
+        self, pairs: typing.List[typing.Tuple[pathlib.Path, pathlib.Path]]
+    ) -> typing.List[_PairResult]:
+        return list(self(pairs))
+
+
+def _pair_dirs(
+    args: argparse.Namespace,
+) -> typing.Tuple[typing.List[pathlib.Path], typing.List[pathlib.Path]]:
+    """prediction and truth files of the pairs in the input directories"""
+    logger = logging.getLogger(__name__)
+    if args.pairing == "order":
+        pred_fns = lmcc.glob_imgs(args.pred_dir, recursive=args.recursive)
+        truth_fns = lmcc.glob_imgs(args.truth_dir, recursive=args.recursive)
+        return pred_fns, truth_fns
+    indices = []
+    for path, prefix, suffix in (
+        (args.pred_dir, args.pred_prefix, args.pred_suffix),
+        (args.truth_dir, args.truth_prefix, args.truth_suffix),
+    ):
+        rule = lmcc.StemRule(prefix, suffix, args.stem_pattern)
+        indices.append(lmcc.index_imgs(path, rule, recursive=args.recursive))
+    pairs, pred_only, truth_only = lmcc.pair_by_stem(*indices)
+    for name, unmatched in (("prediction", pred_only), ("truth", truth_only)):
+        if unmatched:
+            shown = ", ".join(str(fn) for fn in unmatched[:5])
+            more = "" if len(unmatched) <= 5 else f" (and {len(unmatched) - 5} more)"
+            logger.warning(
+                f"Skipping {len(unmatched)} {name} image(s) without a "
+                f"counterpart: {shown}{more}"
+            )
+    return [pf for pf, _ in pairs], [tf for _, tf in pairs]
+
+
+def _subjects(
+    args: argparse.Namespace,
+    truth_fns: typing.List[pathlib.Path],
+    csv: typing.Optional[pd.DataFrame],
+) -> typing.Optional[typing.List[builtins.str]]:
+    """subject of each pair for the bootstrap (None resamples the pairs)"""
+    if csv is not None and "subject" in csv:
+        return [str(subject) for subject in csv["subject"].to_list()]
+    if args.subject_pattern is None:
+        return None
+    pattern = re.compile(args.subject_pattern)
+    subjects = []
+    for fn in truth_fns:
+        match = pattern.search(fn.name)
+        if match is None:
+            raise ValueError(f"--subject-pattern does not match {fn.name}.")
+        subjects.append(match.group(1) if pattern.groups else match.group(0))
+    return subjects
+
+
+def _confidence_interval_rows(
+    args: argparse.Namespace,
+    values: typing.Dict[builtins.str, typing.List[builtins.float]],
+    subjects: typing.Optional[typing.List[builtins.str]],
+) -> typing.List[typing.Dict[builtins.str, typing.Any]]:
+    """rows with the lower and upper bounds of the bootstrap confidence
+    intervals of the column means (and the correlations); like the summary
+    rows, the interval of a column with a NaN (and of a correlation of
+    such a column) is NaN"""
+    kwargs: typing.Dict[builtins.str, typing.Any] = dict(
+        confidence=args.confidence, n_replicates=args.bootstrap, groups=subjects
+    )
+    columns = list(values)
+    data = np.array([values[column] for column in columns], dtype=float).T
+    has_nan = dict(zip(columns, np.isnan(data).any(axis=0).tolist()))
+    intervals = dict(zip(columns, lmb.mean_confidence_intervals(data, **kwargs)))
+    if args.output_correlation:
+        pairs = [("pred_volume", "truth_volume"), ("pred_count", "truth_count")]
+        for name, (x, y) in zip(CORRELATIONS, pairs):
+            xs, ys = values[COLUMNS[x]], values[COLUMNS[y]]
+            has_nan[name] = has_nan[COLUMNS[x]] or has_nan[COLUMNS[y]]
+            intervals[name] = lmb.correlation_confidence_interval(xs, ys, **kwargs)
+    label = f"{args.confidence * 100:g}% CI"
+    lower: typing.Dict[builtins.str, typing.Any] = {"Truth": f"{label} Low"}
+    upper: typing.Dict[builtins.str, typing.Any] = {"Truth": f"{label} High"}
+    for column, interval in intervals.items():
+        nan = has_nan[column]
+        lower[column] = float("nan") if nan else interval.lower
+        upper[column] = float("nan") if nan else interval.upper
+    return [lower, upper]
+
+
+def _evaluation_params(
+    evaluation: _PairEvaluation,
+) -> typing.Dict[builtins.str, typing.Any]:
+    """parameters which change the results of an evaluation"""
+    params = dataclasses.asdict(evaluation)
+    for key in ("prefetch", "prefetch_bytes"):  # don't change results
+        del params[key]
+    return params
+
+
+def _shard_fingerprint(
+    pairs: typing.List[typing.Tuple[pathlib.Path, pathlib.Path]],
+    evaluation: _PairEvaluation,
+    args: argparse.Namespace,
+) -> builtins.str:
+    """hash of the full pair list (in the order it is sharded) and the
+    parameters of a sharded run; shards only merge if theirs are equal"""
+    parts = {
+        "pairs": [[str(pf), str(tf)] for pf, tf in pairs],
+        "params": _evaluation_params(evaluation),
+        "quantile_sketch": args.quantile_sketch,
+        "output_correlation": args.output_correlation,
+    }
+    encoded = json.dumps(parts, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _metrics(args: argparse.Namespace) -> typing.List[builtins.str]:
+    """requested metrics (and those the correlations need) in column order"""
+    requested = set(args.metrics)
+    if args.output_correlation:
+        requested |= {"pred_volume", "truth_volume", "pred_count", "truth_count"}
+    return [metric for metric in COLUMNS if metric in requested]
+
+
 def main(args: lmcc.ArgType = None) -> builtins.int:
     """Console script for lesion_metrics."""
+    if args is None and sys.argv[1:2] == ["merge"]:
+        return lmcm.main(sys.argv[2:])
+    if isinstance(args, list) and args[:1] == ["merge"]:
+        return lmcm.main(args[1:])
     if args is None:
         parser = arg_parser()
         args = parser.parse_args()
@@ -101,9 +559,9 @@ def main(args: lmcc.ArgType = None) -> builtins.int:
     logger = logging.getLogger(__name__)
     use_dirs = args.pred_dir is not None and args.truth_dir is not None
     use_csv = args.in_file is not None
+    csv: typing.Optional[pd.DataFrame] = None
     if use_dirs and not use_csv:
-        pred_fns = lmcc.glob_imgs(args.pred_dir)
-        truth_fns = lmcc.glob_imgs(args.truth_dir)
+        pred_fns, truth_fns = _pair_dirs(args)
     elif use_csv and not use_dirs:
         csv = pd.read_csv(args.in_file)
         pred_fns = [pathlib.Path(f) for f in csv["pred"].to_list()]
@@ -125,91 +583,141 @@ def main(args: lmcc.ArgType = None) -> builtins.int:
             "If --output-correlation enabled, the input "
             "directories must contain more than 1 image."
         )
-    dcs, jis, ppvs, tprs, lfdrs, ltprs, avds, isbis = [], [], [], [], [], [], [], []
-    pfns: typing.List[typing.Optional[builtins.str]] = []
-    tfns: typing.List[typing.Optional[builtins.str]] = []
-    pred_vols, truth_vols = [], []
-    pred_counts, truth_counts = [], []
-    for pf, tf in zip(pred_fns, truth_fns):
-        lmcc.check_files(pf, tf)
-        _, pfn, _ = lmcc.split_filename(pf)
-        _, tfn, _ = lmcc.split_filename(tf)
-        pfns.append(pfn)
-        tfns.append(tfn)
-        _pred = mioi.Image.from_path(pf)
-        _truth = mioi.Image.from_path(tf)
-        pred_vols.append(lmv.SegmentationVolume(_pred).volume())
-        truth_vols.append(lmv.SegmentationVolume(_truth).volume())
-        pred = _pred.squeeze()
-        truth = _truth.squeeze()
-        dcs.append(lmm.dice(pred, truth))
-        jis.append(lmm.jaccard(pred, truth))
-        ppvs.append(lmm.ppv(pred, truth))
-        tprs.append(lmm.tpr(pred, truth))
-        __lfdr = lmm.lfdr(
-            pred, truth, iou_threshold=args.iou_threshold, return_pred_count=True
-        )
-        assert isinstance(__lfdr, tuple)
-        _lfdr, n_pred = __lfdr
-        lfdrs.append(_lfdr)
-        __ltpr = lmm.ltpr(
-            pred, truth, iou_threshold=args.iou_threshold, return_truth_count=True
-        )
-        assert isinstance(__ltpr, tuple)
-        _ltpr, n_truth = __ltpr
-        ltprs.append(_ltpr)
-        avds.append(lmm.avd(pred, truth))
-        isbi15_score = lmm.isbi15_score_from_metrics(
-            dcs[-1], ppvs[-1], lfdrs[-1], ltprs[-1]
-        )
-        isbis.append(isbi15_score)
-        pred_counts.append(n_pred)
-        truth_counts.append(n_truth)
-        logger.info(
-            f"Pred: {pfn}; Truth: {tfn}; Dice: {dcs[-1]:0.2f}; Jacc: {jis[-1]:0.2f}; "
-            f"PPV: {ppvs[-1]:0.2f}; TPR: {tprs[-1]:0.2f}; LFDR: {lfdrs[-1]:0.2f}; "
-            f"LTPR: {ltprs[-1]:0.2f}; AVD: {avds[-1]:0.2f}; ISBI15: {isbis[-1]:0.2f}"
-        )
-    dcs_summary = lmcc.summary_statistics(dcs)
-    labels = list(dcs_summary.keys())
-    tfns.extend(labels)
-    pfns = lmcc.pad_with_none_to_length(pfns, len(tfns))
-    dcs.extend(list(dcs_summary.values()))
-    jis.extend(list(lmcc.summary_statistics(jis).values()))
-    ppvs.extend(list(lmcc.summary_statistics(ppvs).values()))
-    tprs.extend(list(lmcc.summary_statistics(tprs).values()))
-    lfdrs.extend(list(lmcc.summary_statistics(lfdrs).values()))
-    ltprs.extend(list(lmcc.summary_statistics(ltprs).values()))
-    avds.extend(list(lmcc.summary_statistics(avds).values()))
-    isbis.extend(list(lmcc.summary_statistics(isbis).values()))
-    pred_vols.extend(list(lmcc.summary_statistics(pred_vols).values()))
-    truth_vols.extend(list(lmcc.summary_statistics(truth_vols).values()))
-    pred_counts.extend(list(lmcc.summary_statistics(pred_counts).values()))
-    truth_counts.extend(list(lmcc.summary_statistics(truth_counts).values()))
-    out = {
-        "Pred": pfns,
-        "Truth": tfns,
-        "Dice": dcs,
-        "Jaccard": jis,
-        "PPV": ppvs,
-        "TPR": tprs,
-        "LFDR": lfdrs,
-        "LTPR": ltprs,
-        "AVD": avds,
-        "ISBI15 Score": isbis,
-        "Pred. Vol.": pred_vols,
-        "Truth. Vol.": truth_vols,
-        "Pred. Count": pred_counts,
-        "Truth. Count": truth_counts,
+    iou_thresholds = _iou_thresholds(args)
+    sweep = len(iou_thresholds) > 1
+    tolerances = args.surface_dice_tolerance or []
+    if any(tol < 0.0 for tol in tolerances):
+        raise ValueError(f"Surface dice tolerances must be >= 0. Got {tolerances}.")
+    metrics = _metrics(args)
+    subjects = _subjects(args, truth_fns, csv)
+    if args.bootstrap is not None:
+        if args.bootstrap < 1 or not 0.0 < args.confidence < 1.0:
+            raise ValueError("--bootstrap must be >= 1 and --confidence in (0, 1).")
+        if args.shard is not None:
+            raise ValueError("--bootstrap needs all pairs; it cannot use --shard.")
+    if args.jobs < 0:
+        raise ValueError(f"--jobs must be non-negative. Got {args.jobs}.")
+    pairs = list(zip(pred_fns, truth_fns))
+    all_pairs = pairs
+    if args.shard is not None:
+        index, count = args.shard
+        pairs = pairs[index * n_pred // count : (index + 1) * n_pred // count]
+        logger.info(f"Shard {index}/{count}: {len(pairs)} of {n_pred} pair(s).")
+    if csv is not None:  # files found in the directories exist
+        lmcc.check_files(*itertools.chain.from_iterable(pairs))
+    if args.prefetch < 0 or args.prefetch_memory <= 0:
+        raise ValueError("--prefetch must be >= 0 and --prefetch-memory > 0.")
+    evaluation = _PairEvaluation(
+        metrics,
+        iou_thresholds,
+        tolerances,
+        prefetch=args.prefetch,
+        prefetch_bytes=int(args.prefetch_memory * 2**20),
+    )
+    columns = [COLUMNS[metric] for metric in metrics]
+    if sweep:
+        for thresh in iou_thresholds:
+            if "lfdr" in metrics:
+                columns.append(f"LFDR@{thresh:g}")
+            if "ltpr" in metrics:
+                columns.append(f"LTPR@{thresh:g}")
+    columns.extend(f"Surface Dice@{tol:g}" for tol in tolerances)
+    summaries = {
+        column: lmcc.SummaryAccumulator(sketch_size=args.quantile_sketch)
+        for column in columns
+    }
+    # per-pair values are only kept (in memory) for the bootstrap
+    bootstrap_values: typing.Dict[builtins.str, typing.List[builtins.float]] = {
+        column: [] for column in (columns if args.bootstrap else [])
     }
+    vol_corr, count_corr = lmcc.CorrelationAccumulator(), lmcc.CorrelationAccumulator()
+    out_columns = ["Pred", "Truth"] + columns
     if args.output_correlation:
-        vc = lmm.corr(pred_vols, truth_vols)
+        out_columns += CORRELATIONS
+    pair_results: typing.Iterator[_PairResult]
+    with contextlib.ExitStack() as stack:
+        writer = stack.enter_context(lmcc.RowWriter(args.out_file, out_columns))
+        cache: typing.Optional[lmcca.ResultCache] = None
+        keys: typing.List[builtins.str] = []
+        hits: typing.List[typing.Optional[_PairResult]] = [None] * len(pairs)
+        if args.cache is not None:
+            cache = lmcca.ResultCache(
+                args.cache,
+                checkpoint_every=args.checkpoint_every,
+                content_hash=args.cache_content_hash,
+            )
+            stack.enter_context(cache)
+            params = _evaluation_params(evaluation)
+            keys = [cache.key(pf, tf, params) for pf, tf in pairs]
+            hits = [_PairResult.from_dict(cache.get(key)) for key in keys]
+            logger.info(f"Found {len(pairs) - hits.count(None)} cached pair(s).")
+        todo = [pair for pair, hit in zip(pairs, hits) if hit is None]
+        if args.jobs == 1 or not todo:
+            pair_results = evaluation(todo)
+        else:
+            n_workers = args.jobs or os.cpu_count() or 1
+            executor = concurrent.futures.ProcessPoolExecutor(n_workers)
+            stack.enter_context(executor)
+            # each worker evaluates a chunk of pairs (prefetching within it);
+            # results come back in input order (logged here as they arrive)
+            size = min(max(len(todo) // (4 * n_workers), 1), 32)
+            chunks = [todo[i : i + size] for i in range(0, len(todo), size)]
+            results_per_chunk = executor.map(evaluation.evaluate_chunk, chunks)
+            pair_results = itertools.chain.from_iterable(results_per_chunk)
+        if cache is not None:
+            pair_results = _merge_cached(cache, keys, hits, pair_results)
+        for (pf, tf), pair_result in zip(pairs, pair_results):
+            _, pfn, _ = lmcc.split_filename(pf)
+            _, tfn, _ = lmcc.split_filename(tf)
+            values = pair_result.values
+            row: typing.Dict[builtins.str, typing.Any] = {"Pred": pfn, "Truth": tfn}
+            row.update((COLUMNS[metric], value) for metric, value in values.items())
+            for i, thresh in enumerate(iou_thresholds if sweep else []):
+                if pair_result.lfdr_curve is not None:
+                    row[f"LFDR@{thresh:g}"] = pair_result.lfdr_curve[i]
+                if pair_result.ltpr_curve is not None:
+                    row[f"LTPR@{thresh:g}"] = pair_result.ltpr_curve[i]
+            for tol, sd in zip(tolerances, pair_result.surface_dice):
+                row[f"Surface Dice@{tol:g}"] = sd
+            writer.write(row)
+            for column, summary in summaries.items():
+                summary.update(row[column])
+            for column, column_values in bootstrap_values.items():
+                column_values.append(row[column])
+            if args.output_correlation:
+                vol_corr.add(values["pred_volume"], values["truth_volume"])
+                count_corr.add(values["pred_count"], values["truth_count"])
+            logger.info(
+                f"Pred: {pfn}; Truth: {tfn}; "
+                + "; ".join(f"{COLUMNS[m]}: {v:0.2f}" for m, v in values.items())
+            )
+        if args.shard is None:
+            lmcc.write_summary_rows(writer, summaries)
+        if args.bootstrap:
+            for row in _confidence_interval_rows(args, bootstrap_values, subjects):
+                writer.write(row)
+    if args.shard is not None:
+        state = {
+            "shard": list(args.shard),
+            "n_pairs": n_pred,
+            "fingerprint": _shard_fingerprint(all_pairs, evaluation, args),
+            "out_columns": out_columns,
+            "summaries": {c: s.to_dict() for c, s in summaries.items()},
+            "correlations": (
+                dict(zip(CORRELATIONS, [vol_corr.to_dict(), count_corr.to_dict()]))
+                if args.output_correlation
+                else None
+            ),
+        }
+        state_path = lmcc.partial_state_path(args.out_file)
+        state_path.write_text(json.dumps(state))
+        logger.info(f"Wrote partial result state to {state_path}.")
+    elif args.output_correlation:
+        vc = vol_corr.correlation()
         logger.info(f"Volume correlation: {vc:0.2f}")
-        out["Vol. Correlation"] = lmcc.pad_with_none_to_length([vc], len(truth_vols))
-        cc = lmm.corr(pred_counts, truth_counts)
+        cc = count_corr.correlation()
         logger.info(f"Count correlation: {cc:0.2f}")
-        out["Count Correlation"] = lmcc.pad_with_none_to_length([cc], len(truth_vols))
-    pd.DataFrame(out).to_csv(args.out_file, index=False)
+        writer.update_first_row(dict(zip(CORRELATIONS, [vc, cc])))
     return 0
 
 
@@ -0,0 +1,105 @@
+"""Persistent cache of per-pair results for resumable evaluations
+
+results are stored as JSON in an sqlite database under a key built from
+the pred/truth paths, their size and modification time (or a hash of
+their content) and the evaluation parameters, so a rerun only evaluates
+the pairs which changed (or were not finished before a crash)
+"""
+
+__all__ = [
+    "ResultCache",
+]
+
+import builtins
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import types
+import typing
+
+import lesion_metrics
+
+
+class ResultCache:
+    """sqlite-backed JSON result store; writes are committed (checkpointed)
+    every `checkpoint_every` puts and when the cache is closed"""
+
+    def __init__(
+        self,
+        path: typing.Union[os.PathLike, builtins.str],
+        *,
+        checkpoint_every: builtins.int = 50,
+        content_hash: builtins.bool = False,
+    ):
+        if checkpoint_every < 1:
+            raise ValueError(f"checkpoint_every must be >= 1. Got {checkpoint_every}.")
+        self.path = pathlib.Path(path)
+        self.checkpoint_every = checkpoint_every
+        self.content_hash = content_hash
+        self._connection = sqlite3.connect(os.fspath(self.path))
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self._connection.commit()
+        self._n_uncommitted = 0
+
+    def __enter__(self) -> "ResultCache":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: typing.Optional[typing.Type[BaseException]],
+        exc: typing.Optional[BaseException],
+        tb: typing.Optional[types.TracebackType],
+    ) -> None:
+        self.close()
+
+    def _fingerprint(self, path: pathlib.Path) -> typing.List[typing.Any]:
+        path = path.resolve()
+        if self.content_hash:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(2**20), b""):
+                    digest.update(block)
+            return [str(path), digest.hexdigest()]
+        stat = path.stat()
+        return [str(path), stat.st_size, stat.st_mtime_ns]
+
+    def key(
+        self,
+        pred_fn: pathlib.Path,
+        truth_fn: pathlib.Path,
+        params: typing.Dict[builtins.str, typing.Any],
+    ) -> builtins.str:
+        """key of a pair of files evaluated with the given parameters"""
+        parts = {
+            "pred": self._fingerprint(pred_fn),
+            "truth": self._fingerprint(truth_fn),
+            "params": params,
+            "version": lesion_metrics.__version__,
+        }
+        encoded = json.dumps(parts, sort_keys=True).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get(self, key: builtins.str) -> typing.Optional[typing.Any]:
+        query = "SELECT value FROM results WHERE key = ?"
+        row = self._connection.execute(query, (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key: builtins.str, value: typing.Any) -> None:
+        query = "INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)"
+        self._connection.execute(query, (key, json.dumps(value)))
+        self._n_uncommitted += 1
+        if self._n_uncommitted >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """commit the results written so far"""
+        self._connection.commit()
+        self._n_uncommitted = 0
+
+    def close(self) -> None:
+        self.checkpoint()
+        self._connection.close()
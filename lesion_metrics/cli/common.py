@@ -5,29 +5,54 @@ Created on: 05 Dec 2021
 
 __all__ = [
     "ArgType",
+    "CorrelationAccumulator",
+    "QuantileSketch",
+    "RowWriter",
+    "StemRule",
+    "SummaryAccumulator",
     "check_files",
     "csv_file_path",
     "dir_path",
     "dir_or_file_path",
     "file_path",
     "glob_imgs",
+    "index_imgs",
+    "pair_by_stem",
     "pad_with_none_to_length",
+    "partial_state_path",
+    "prefetch",
+    "read_rows",
+    "scan_imgs",
     "setup_log",
+    "shard_spec",
     "split_filename",
     "summary_statistics",
+    "table_file_path",
+    "write_summary_rows",
 ]
 
 import argparse
+import array
 import builtins
 import collections
-import functools
+import concurrent.futures
+import csv
+import dataclasses
+import fnmatch
+import json
 import logging
+import math
 import os
 import pathlib
+import re
+import tempfile
 import typing
 
 import numpy as np
 
+T = typing.TypeVar("T")
+R = typing.TypeVar("R")
+
 ArgType = typing.Optional[typing.Union[argparse.Namespace, typing.List[builtins.str]]]
 
 
@@ -96,6 +121,19 @@ class csv_file_path(_ParseType):
         return path
 
 
+class table_file_path(_ParseType):
+    def __call__(self, string: builtins.str) -> pathlib.Path:
+        if not string.endswith((".csv", ".jsonl")) or not string.isprintable():
+            msg = (
+                f"{string} is not a valid path to a csv or jsonl file.\n"
+                "file needs to end with csv or jsonl and only contain "
+                "printable characters."
+            )
+            raise argparse.ArgumentTypeError(msg)
+        path = pathlib.Path(string)
+        return path
+
+
 class dir_path(_ParseType):
     def __call__(self, string: builtins.str) -> pathlib.Path:
         path = pathlib.Path(string)
@@ -114,11 +152,117 @@ class dir_or_file_path(_ParseType):
         return path
 
 
+class shard_spec(_ParseType):
+    def __call__(
+        self, string: builtins.str
+    ) -> typing.Tuple[builtins.int, builtins.int]:
+        index, _, count = string.partition("/")
+        try:
+            shard = int(index), int(count)
+        except ValueError:
+            shard = (-1, 0)
+        if not 0 <= shard[0] < shard[1]:
+            msg = f"{string} is not a valid shard; expected i/N with 0 <= i < N."
+            raise argparse.ArgumentTypeError(msg)
+        return shard
+
+
+def scan_imgs(
+    path: pathlib.Path,
+    ext: builtins.str = "*.nii*",
+    *,
+    recursive: builtins.bool = False,
+) -> typing.Iterator[pathlib.Path]:
+    """`ext` files in a directory (and, if `recursive`, its subdirectories)
+    in one `os.scandir` pass per directory, i.e., without a stat per file;
+    like `pathlib.Path.glob`, hidden files (e.g., `._x.nii.gz`) are included"""
+    directories = [path]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if recursive and entry.is_dir():
+                    directories.append(pathlib.Path(entry.path))
+                elif fnmatch.fnmatchcase(entry.name, ext) and entry.is_file():
+                    yield pathlib.Path(entry.path)
+
+
 def glob_imgs(
-    path: pathlib.Path, ext: builtins.str = "*.nii*"
+    path: pathlib.Path,
+    ext: builtins.str = "*.nii*",
+    *,
+    recursive: builtins.bool = False,
 ) -> typing.List[pathlib.Path]:
     """grab all `ext` files in a directory and sort them for consistency"""
-    return sorted(path.glob(ext))
+    return sorted(scan_imgs(path, ext, recursive=recursive))
+
+
+@dataclasses.dataclass(frozen=True)
+class StemRule:
+    """normalized stem of an image file used to pair predictions and truths
+
+    the base name (see `split_filename`) without the `prefix` and `suffix`
+    (if present) and, given a `pattern`, reduced to the first group (or the
+    whole match) of the regular expression; None if the pattern does not match
+    """
+
+    prefix: builtins.str = ""
+    suffix: builtins.str = ""
+    pattern: typing.Optional[builtins.str] = None
+
+    def __call__(self, path: pathlib.Path) -> typing.Optional[builtins.str]:
+        _, stem, _ = split_filename(path)
+        if self.prefix and stem.startswith(self.prefix):
+            stem = stem[len(self.prefix) :]
+        if self.suffix and stem.endswith(self.suffix):
+            stem = stem[: -len(self.suffix)]
+        if self.pattern is not None:
+            match = re.search(self.pattern, stem)
+            if match is None:
+                return None
+            stem = match.group(1) if match.re.groups else match.group(0)
+        return stem
+
+
+def index_imgs(
+    path: pathlib.Path,
+    rule: StemRule,
+    ext: builtins.str = "*.nii*",
+    *,
+    recursive: builtins.bool = False,
+) -> typing.Dict[builtins.str, pathlib.Path]:
+    """image files in a directory keyed by their normalized stem (files
+    without a stem are skipped; a stem shared by two files is an error)"""
+    index: typing.Dict[builtins.str, pathlib.Path] = {}
+    for fn in scan_imgs(path, ext, recursive=recursive):
+        stem = rule(fn)
+        if stem is None:
+            continue
+        if stem in index:
+            msg = f"{index[stem]} and {fn} have the same stem ({stem})."
+            raise ValueError(msg)
+        index[stem] = fn
+    return index
+
+
+def pair_by_stem(
+    pred_index: typing.Dict[builtins.str, pathlib.Path],
+    truth_index: typing.Dict[builtins.str, pathlib.Path],
+) -> typing.Tuple[
+    typing.List[typing.Tuple[pathlib.Path, pathlib.Path]],
+    typing.List[pathlib.Path],
+    typing.List[pathlib.Path],
+]:
+    """pairs of files with the same stem (sorted by stem) and the
+    unmatched prediction and truth files"""
+    pairs = [
+        (pred_index[stem], truth_index[stem])
+        for stem in sorted(pred_index.keys() & truth_index.keys())
+    ]
+    pred_only = [pred_index[s] for s in sorted(pred_index.keys() - truth_index.keys())]
+    truth_only = [
+        truth_index[s] for s in sorted(truth_index.keys() - pred_index.keys())
+    ]
+    return pairs, pred_only, truth_only
 
 
 def check_files(*files: pathlib.Path) -> None:
@@ -130,19 +274,382 @@ def check_files(*files: pathlib.Path) -> None:
         raise ValueError(msg + "Aborting.")
 
 
+_PERCENTILES = (25.0, 50.0, 75.0)
+
+
+def _summary(
+    mean: builtins.float,
+    std: builtins.float,
+    minimum: builtins.float,
+    percentiles: typing.Sequence[builtins.float],
+    maximum: builtins.float,
+) -> collections.OrderedDict:
+    summary: collections.OrderedDict[builtins.str, builtins.float]
+    summary = collections.OrderedDict()
+    summary["Avg"] = mean
+    summary["Std"] = std
+    summary["Min"] = minimum
+    summary["25%"], summary["50%"], summary["75%"] = percentiles
+    summary["Max"] = maximum
+    return summary
+
+
 def summary_statistics(
     data: typing.Sequence[builtins.float],
 ) -> collections.OrderedDict:
-    funcs: collections.OrderedDict[builtins.str, typing.Callable]
-    funcs = collections.OrderedDict()
-    funcs["Avg"] = np.mean
-    funcs["Std"] = np.std
-    funcs["Min"] = np.min
-    funcs["25%"] = functools.partial(np.percentile, q=25.0)
-    funcs["50%"] = np.median
-    funcs["75%"] = functools.partial(np.percentile, q=75.0)
-    funcs["Max"] = np.max
-    return collections.OrderedDict((label, f(data)) for label, f in funcs.items())
+    values = np.asarray(data, dtype=np.float64)
+    percentiles = np.percentile(values, _PERCENTILES).tolist()  # one sort
+    return _summary(
+        values.mean(), values.std(), values.min(), percentiles, values.max()
+    )
+
+
+class QuantileSketch:
+    """mergeable, bounded-memory quantile sketch (a KLL sketch [1])
+
+    items are kept in compactors whose items weigh 2**level; a full
+    compactor is sorted and every other item (from a random offset) is
+    promoted to the next level. with `k` items in the top compactor, the
+    rank error of a quantile is about 1.7 / k of the number of values
+    with high probability, independent of how many values are added
+
+    References:
+        [1] Karnin, Lang, and Liberty. "Optimal quantile approximation
+            in streams." FOCS (2016): 71-78.
+    """
+
+    def __init__(self, k: builtins.int = 200, *, seed: builtins.int = 0):
+        if k < 8:
+            raise ValueError(f"Sketch size k must be >= 8. Got {k}.")
+        self.k = k
+        self.n = 0
+        self.compactors: typing.List[typing.List[builtins.float]] = [[]]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level: builtins.int) -> builtins.int:
+        depth = len(self.compactors) - level - 1
+        return max(int(math.ceil(self.k * (2.0 / 3.0) ** depth)), 2)
+
+    def _size(self) -> builtins.int:
+        return sum(len(c) for c in self.compactors)
+
+    def _max_size(self) -> builtins.int:
+        return sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _compress(self) -> None:
+        while self._size() > self._max_size():
+            for level, compactor in enumerate(self.compactors):
+                if len(compactor) >= self._capacity(level):
+                    if level + 1 == len(self.compactors):
+                        self.compactors.append([])
+                    compactor.sort()
+                    odd = len(compactor) % 2
+                    offset = int(self._rng.integers(2))
+                    end = len(compactor) - odd
+                    self.compactors[level + 1].extend(compactor[offset:end:2])
+                    self.compactors[level] = compactor[end:]
+                    break
+
+    def update(self, value: builtins.float) -> None:
+        if math.isnan(value):
+            raise ValueError("NaN cannot be ordered in a quantile sketch.")
+        self.n += 1
+        self.compactors[0].append(value)
+        if len(self.compactors[0]) >= self._capacity(0):
+            self._compress()
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        """add the values summarized in another sketch to this one"""
+        if other.k != self.k:
+            raise ValueError(f"Cannot merge sketches of size {self.k} and {other.k}.")
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for compactor, items in zip(self.compactors, other.compactors):
+            compactor.extend(items)
+        self.n += other.n
+        self._compress()
+        return self
+
+    def to_dict(self) -> typing.Dict[builtins.str, typing.Any]:
+        return {"k": self.k, "n": self.n, "compactors": self.compactors}
+
+    @classmethod
+    def from_dict(cls, data: typing.Dict[builtins.str, typing.Any]) -> "QuantileSketch":
+        sketch = cls(data["k"])
+        sketch.n = data["n"]
+        sketch.compactors = [list(compactor) for compactor in data["compactors"]]
+        return sketch
+
+    def percentiles(self, q: typing.Sequence[builtins.float]) -> np.ndarray:
+        """approximate percentiles (linearly interpolated like np.percentile)"""
+        if self.n == 0:
+            return np.full(len(q), np.nan)
+        items = np.concatenate([np.asarray(c, dtype=float) for c in self.compactors])
+        weights = np.concatenate(
+            [np.full(len(c), 2.0**h) for h, c in enumerate(self.compactors)]
+        )
+        order = np.argsort(items, kind="stable")
+        items, weights = items[order], weights[order]
+        # center of the positions (0 to n - 1) of the values each item stands
+        # for; all weights are 1 (and the result is exact) before compaction
+        positions = np.cumsum(weights) - (weights + 1.0) / 2.0
+        ranks = np.asarray(q, dtype=np.float64) / 100.0 * (self.n - 1)
+        out: np.ndarray = np.interp(ranks, positions, items)
+        return out
+
+
+class SummaryAccumulator:
+    """mergeable running summary statistics of a column of values
+
+    the mean and standard deviation are updated with welford's algorithm
+    (and merged with chan et al.'s formula), the minimum and maximum are
+    exact and the percentiles are exact (all values are kept as doubles)
+    or, given a `sketch_size`, estimated in bounded memory by a
+    `QuantileSketch`; `statistics` finalizes to the `summary_statistics`
+    (like those, every statistic is NaN if any value is NaN)
+    """
+
+    def __init__(self, *, sketch_size: typing.Optional[builtins.int] = None):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.has_nan = False
+        self.values: typing.Optional[array.array] = None
+        self.sketch: typing.Optional[QuantileSketch] = None
+        if sketch_size is None:
+            self.values = array.array("d")
+        else:
+            self.sketch = QuantileSketch(sketch_size)
+
+    def update(self, value: builtins.float) -> None:
+        if math.isnan(value):  # min/max (and sorting) would skip it
+            self.has_nan = True
+            return
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if self.values is not None:
+            self.values.append(value)
+        else:
+            assert self.sketch is not None
+            self.sketch.update(value)
+
+    def merge(self, other: "SummaryAccumulator") -> "SummaryAccumulator":
+        """combine with the summary of another set of values (in place)"""
+        self.has_nan |= other.has_nan
+        n = self.n + other.n
+        if n == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta**2 * self.n * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if self.values is not None and other.values is not None:
+            self.values.extend(other.values)
+        elif self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+        else:
+            raise ValueError("Cannot merge exact and sketched summaries.")
+        return self
+
+    def to_dict(self) -> typing.Dict[builtins.str, typing.Any]:
+        """sufficient statistics (json-serializable) to restore the summary"""
+        return {
+            "n": self.n,
+            "mean": self.mean,
+            "m2": self.m2,
+            "min": self.min,
+            "max": self.max,
+            "has_nan": self.has_nan,
+            "values": None if self.values is None else self.values.tolist(),
+            "sketch": None if self.sketch is None else self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(
+        cls, data: typing.Dict[builtins.str, typing.Any]
+    ) -> "SummaryAccumulator":
+        sketch = data["sketch"]
+        summary = cls(sketch_size=None if sketch is None else sketch["k"])
+        summary.n, summary.mean, summary.m2 = data["n"], data["mean"], data["m2"]
+        summary.min, summary.max = data["min"], data["max"]
+        summary.has_nan = data["has_nan"]
+        if sketch is None:
+            summary.values = array.array("d", data["values"])
+        else:
+            summary.sketch = QuantileSketch.from_dict(sketch)
+        return summary
+
+    def statistics(self) -> collections.OrderedDict:
+        if self.n == 0 or self.has_nan:
+            nan = float("nan")
+            return _summary(nan, nan, nan, [nan] * len(_PERCENTILES), nan)
+        if self.values is not None:
+            percentiles = np.percentile(self.values, _PERCENTILES).tolist()
+        else:
+            assert self.sketch is not None
+            percentiles = self.sketch.percentiles(_PERCENTILES).tolist()
+        std = math.sqrt(self.m2 / self.n)
+        return _summary(self.mean, std, self.min, percentiles, self.max)
+
+
+class CorrelationAccumulator:
+    """pearson correlation of (x, y) pairs added one at a time in constant
+    memory (running means and co-moments)"""
+
+    def __init__(self) -> None:
+        self.n = 0
+        self.mean_x = self.mean_y = 0.0
+        self.m2_x = self.m2_y = self.c_xy = 0.0
+
+    def add(self, x: builtins.float, y: builtins.float) -> None:
+        self.n += 1
+        dx = x - self.mean_x
+        self.mean_x += dx / self.n
+        dy = y - self.mean_y
+        self.mean_y += dy / self.n
+        self.m2_x += dx * (x - self.mean_x)
+        self.m2_y += dy * (y - self.mean_y)
+        self.c_xy += dx * (y - self.mean_y)
+
+    def merge(self, other: "CorrelationAccumulator") -> "CorrelationAccumulator":
+        """combine with the pairs added to another accumulator (in place)"""
+        n = self.n + other.n
+        if n == 0:
+            return self
+        dx = other.mean_x - self.mean_x
+        dy = other.mean_y - self.mean_y
+        scale = self.n * other.n / n
+        self.m2_x += other.m2_x + dx * dx * scale
+        self.m2_y += other.m2_y + dy * dy * scale
+        self.c_xy += other.c_xy + dx * dy * scale
+        self.mean_x += dx * other.n / n
+        self.mean_y += dy * other.n / n
+        self.n = n
+        return self
+
+    def to_dict(self) -> typing.Dict[builtins.str, builtins.float]:
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(
+        cls, data: typing.Dict[builtins.str, builtins.float]
+    ) -> "CorrelationAccumulator":
+        correlation = cls()
+        vars(correlation).update(data)
+        return correlation
+
+    def correlation(self) -> builtins.float:
+        denom = math.sqrt(self.m2_x * self.m2_y)
+        return self.c_xy / denom if denom > 0.0 else float("nan")
+
+
+class RowWriter:
+    """write rows (dicts keyed by column) to a csv or, if the path ends
+    with `.jsonl`, a json lines file as soon as they are available
+
+    every row is flushed so partial results can be read while a run is in
+    progress; missing columns and NaNs are written as empty (null) values
+    """
+
+    def __init__(self, path: pathlib.Path, columns: typing.Sequence[builtins.str]):
+        self.path = path
+        self.columns = list(columns)
+        self.jsonl = path.suffix == ".jsonl"
+        self._file = open(path, "w", newline="")
+        self._csv = csv.writer(self._file, lineterminator="\n")
+        if not self.jsonl:
+            self._csv.writerow(self.columns)
+            self._file.flush()
+
+    def __enter__(self) -> "RowWriter":
+        return self
+
+    def __exit__(self, *exc_info: typing.Any) -> None:
+        self.close()
+
+    @staticmethod
+    def _value(value: typing.Any) -> typing.Any:
+        if value is None or isinstance(value, str):
+            return value
+        value = float(value)
+        return None if math.isnan(value) else value
+
+    def write(self, row: typing.Dict[builtins.str, typing.Any]) -> None:
+        values = [self._value(row.get(column)) for column in self.columns]
+        if self.jsonl:
+            record = dict(zip(self.columns, values))
+            self._file.write(json.dumps(record, allow_nan=False) + "\n")
+        else:
+            self._csv.writerow(["" if v is None else v for v in values])
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def update_first_row(self, row: typing.Dict[builtins.str, typing.Any]) -> None:
+        """set columns of the first row after the file is closed (e.g.,
+        with statistics of all rows) by streaming a rewritten copy"""
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, suffix=self.path.suffix)
+        with open(self.path, newline="") as src, os.fdopen(fd, "w", newline="") as dst:
+            if not self.jsonl:
+                dst.write(src.readline())  # header
+            first = src.readline()
+            if self.jsonl:
+                record = json.loads(first)
+                record.update({k: self._value(v) for k, v in row.items()})
+                dst.write(json.dumps(record, allow_nan=False) + "\n")
+            else:
+                fields = next(csv.reader([first]))
+                for column, value in row.items():
+                    value = self._value(value)
+                    fields[self.columns.index(column)] = "" if value is None else value
+                csv.writer(dst, lineterminator="\n").writerow(fields)
+            for line in src:
+                dst.write(line)
+        os.replace(tmp, self.path)
+
+
+def write_summary_rows(
+    writer: RowWriter, summaries: typing.Dict[builtins.str, SummaryAccumulator]
+) -> None:
+    """append a row per summary statistic (labeled in the `Truth` column)"""
+    statistics = {column: s.statistics() for column, s in summaries.items()}
+    for label in next(iter(statistics.values())):
+        row = {column: stats[label] for column, stats in statistics.items()}
+        row["Truth"] = label
+        writer.write(row)
+
+
+def read_rows(
+    path: pathlib.Path, numeric: typing.Collection[builtins.str] = ()
+) -> typing.Iterator[typing.Dict[builtins.str, typing.Any]]:
+    """rows of a csv or json lines file written by `RowWriter`; values of
+    the `numeric` columns of a csv are parsed as floats (empty as None)"""
+    with open(path, newline="") as f:
+        if path.suffix == ".jsonl":
+            for line in f:
+                yield json.loads(line)
+            return
+        for row in csv.DictReader(f):
+            parsed: typing.Dict[builtins.str, typing.Any] = dict(row)
+            for column in numeric:
+                value = parsed.get(column)
+                parsed[column] = float(value) if value else None
+            yield parsed
+
+
+def partial_state_path(path: pathlib.Path) -> pathlib.Path:
+    """json file next to a partial (sharded) result file holding the
+    state needed to merge it with the other shards"""
+    return path.with_name(path.name + ".state.json")
 
 
 def pad_with_none_to_length(
@@ -155,3 +662,54 @@ def pad_with_none_to_length(
     padded = lst + ([None] * n)
     assert len(padded) == length
     return padded
+
+
+def _nbytes(obj: typing.Any) -> builtins.int:
+    """bytes held by an array or a tuple/list of arrays (0 for other objects)"""
+    if isinstance(obj, (tuple, list)):
+        return sum(_nbytes(o) for o in obj)
+    return int(getattr(obj, "nbytes", 0))
+
+
+def prefetch(
+    func: typing.Callable[[T], R],
+    items: typing.Iterable[T],
+    *,
+    depth: builtins.int = 2,
+    max_bytes: typing.Optional[builtins.int] = None,
+    sizeof: typing.Callable[[typing.Any], builtins.int] = _nbytes,
+) -> typing.Iterator[R]:
+    """`func(item)` for each item in order, computed up to `depth` items
+    ahead in background threads (e.g., to load images while the previous
+    ones are evaluated); depth 0 computes each item on demand
+
+    if `max_bytes` is given, the prefetch depth shrinks so that the results
+    held at once (the one being used plus those loaded ahead, each assumed
+    as large as the largest result so far) stay within `max_bytes`;
+    at least the next item is always loaded ahead
+    """
+    if depth < 1:
+        yield from map(func, items)
+        return
+    iterator = iter(items)
+    pending: typing.Deque[concurrent.futures.Future] = collections.deque()
+    largest = 0
+
+    def fill(executor: concurrent.futures.Executor) -> None:
+        while len(pending) < depth:
+            held = largest * (len(pending) + 2)  # incl. the result in use
+            if max_bytes is not None and pending and held > max_bytes:
+                return
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            pending.append(executor.submit(func, item))
+
+    with concurrent.futures.ThreadPoolExecutor(depth) as executor:
+        fill(executor)
+        while pending:
+            result: R = pending.popleft().result()
+            largest = max(largest, sizeof(result))
+            fill(executor)
+            yield result
@@ -0,0 +1,116 @@
+"""Console script to merge partial (sharded) lesion_metrics results."""
+import argparse
+import builtins
+import json
+import logging
+import pathlib
+import sys
+import typing
+
+import lesion_metrics.cli.common as lmcc
+
+
+def arg_parser() -> argparse.ArgumentParser:
+    desc = (
+        "Merge the partial results of `lesion-metrics --shard i/N` runs into "
+        "the result of a single run (the summary rows and correlations are "
+        "merged from the saved statistics, no images are read)."
+    )
+    parser = argparse.ArgumentParser(prog="lesion-metrics merge", description=desc)
+
+    required = parser.add_argument_group("Required")
+    required.add_argument(
+        "partials",
+        type=lmcc.file_path(),
+        nargs="+",
+        help="paths to the partial result files of all the shards (in any order)",
+    )
+    required.add_argument(
+        "-o",
+        "--out-file",
+        type=lmcc.table_file_path(),
+        required=True,
+        help="path to output csv (or, if it ends with .jsonl, json lines) file",
+    )
+
+    options = parser.add_argument_group("Optional")
+    options.add_argument(
+        "-v",
+        "--verbosity",
+        action="count",
+        default=0,
+        help="increase output verbosity (e.g., -vv is more than -v)",
+    )
+    return parser
+
+
+def _load_states(
+    partials: typing.List[pathlib.Path],
+) -> typing.List[typing.Tuple[pathlib.Path, typing.Dict[builtins.str, typing.Any]]]:
+    """partial result files with their states in shard order (checked to
+    be all the shards of the same evaluation)"""
+    loaded = []
+    for partial in partials:
+        state_path = lmcc.partial_state_path(partial)
+        if not state_path.is_file():
+            raise ValueError(f"{partial} has no partial result state ({state_path}).")
+        loaded.append((partial, json.loads(state_path.read_text())))
+    loaded.sort(key=lambda item: item[1]["shard"][0])
+    first = loaded[0][1]
+    count = first["shard"][1]
+    indices = [state["shard"][0] for _, state in loaded]
+    if indices != list(range(count)):
+        raise ValueError(f"Expected shards 0 to {count - 1}. Got {indices}.")
+    for partial, state in loaded:
+        for key in ("n_pairs", "out_columns", "fingerprint"):
+            if state[key] != first[key] or state["shard"][1] != count:
+                msg = (
+                    f"{partial} is from a different evaluation (other inputs "
+                    "or parameters) than the other shards."
+                )
+                raise ValueError(msg)
+    return loaded
+
+
+def main(args: lmcc.ArgType = None) -> builtins.int:
+    """Console script to merge partial (sharded) lesion_metrics results."""
+    if args is None:
+        parser = arg_parser()
+        args = parser.parse_args()
+    elif isinstance(args, list):
+        parser = arg_parser()
+        args = parser.parse_args(args)
+    lmcc.setup_log(args.verbosity)
+    logger = logging.getLogger(__name__)
+    loaded = _load_states(args.partials)
+    states = [state for _, state in loaded]
+    out_columns = states[0]["out_columns"]
+    summaries = {
+        column: lmcc.SummaryAccumulator.from_dict(summary)
+        for column, summary in states[0]["summaries"].items()
+    }
+    for state in states[1:]:
+        for column, summary in state["summaries"].items():
+            summaries[column].merge(lmcc.SummaryAccumulator.from_dict(summary))
+    numeric = [column for column in out_columns if column not in ("Pred", "Truth")]
+    with lmcc.RowWriter(args.out_file, out_columns) as writer:
+        for partial, _ in loaded:
+            for row in lmcc.read_rows(partial, numeric):
+                writer.write(row)
+        lmcc.write_summary_rows(writer, summaries)
+    if states[0]["correlations"] is not None:
+        correlations = {}
+        for column, correlation in states[0]["correlations"].items():
+            merged = lmcc.CorrelationAccumulator.from_dict(correlation)
+            for state in states[1:]:
+                other = state["correlations"][column]
+                merged.merge(lmcc.CorrelationAccumulator.from_dict(other))
+            correlations[column] = merged.correlation()
+            logger.info(f"{column}: {correlations[column]:0.2f}")
+        writer.update_first_row(correlations)
+    logger.info(f"Merged {len(states)} shard(s) of {states[0]['n_pairs']} pair(s).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
@@ -12,11 +12,10 @@ with warnings.catch_warnings():
     import numpy as np
     import pandas as pd
     import scipy.ndimage
-    import skimage.measure
 
     import lesion_metrics.cli.common as lmcc
-    import lesion_metrics.metrics as lmm
-    import lesion_metrics.utils as lmu
+    import lesion_metrics.context as lmc
+    import lesion_metrics.surface as lms
     import lesion_metrics.volume as lmv
 
 
@@ -77,7 +76,12 @@ def main(args: lmcc.ArgType = None) -> builtins.int:
         parser = arg_parser()
         args = parser.parse_args(args)
     lmcc.setup_log(args.verbosity)
-    pos, dcs, jis, ppvs, tprs, lfdrs, ltprs, avds = [], [], [], [], [], [], [], []
+    pos: typing.List[typing.Union[typing.Tuple[builtins.float, ...], builtins.str]]
+    pos = []
+    dcs, jis, ppvs, tprs, lfdrs, ltprs, avds = [], [], [], [], [], [], []
+    assds: typing.List[builtins.float] = []
+    lesion_vols: typing.List[builtins.float] = []
+    hd95s: typing.List[builtins.float] = []
     pred_vols, truth_vols = [], []
     _, pfn, _ = lmcc.split_filename(args.pred)
     _, tfn, _ = lmcc.split_filename(args.truth)
@@ -87,38 +91,39 @@ def main(args: lmcc.ArgType = None) -> builtins.int:
     _truth = mioi.Image.from_path(args.truth)
     pred_vols.append(lmv.SegmentationVolume(_pred).volume())
     truth_vols.append(lmv.SegmentationVolume(_truth).volume())
-    pred = _pred.squeeze()
-    truth = _truth.squeeze()
-    lfdrs.append(lmm.lfdr(pred, truth, iou_threshold=args.iou_threshold))
-    ltprs.append(lmm.ltpr(pred, truth, iou_threshold=args.iou_threshold))
-    cc_truth, n_truth = skimage.measure.label(truth, return_num=True)
-    cc_pred, _ = skimage.measure.label(pred, return_num=True)
-    for i in range(1, n_truth + 1):
-        truth_lesion_whole_array = cc_truth == i
-        position = tuple(
-            np.round(scipy.ndimage.center_of_mass(truth_lesion_whole_array), decimals=2)
-        )
-        intersecting_lesions = set(np.unique(cc_pred[truth_lesion_whole_array])) - {0}
-        if intersecting_lesions:
-            other_lesions = np.full_like(pred, False)
-            for j in intersecting_lesions:
-                other_lesions |= cc_pred == j
-            lesion_bbox = tuple(lmu.bbox(truth_lesion_whole_array | other_lesions))
-            target_lesion = truth_lesion_whole_array[lesion_bbox]
-            other_lesion = other_lesions[lesion_bbox]
-            _dice = lmm.dice(other_lesion, target_lesion)
-            _iou = lmm.jaccard(other_lesion, target_lesion)
-            _ppv = lmm.ppv(other_lesion, target_lesion)
-            _tpr = lmm.tpr(other_lesion, target_lesion)
-            _avd = lmm.avd(other_lesion, target_lesion)
-        else:
-            _dice = _iou = _ppv = _tpr = _avd = 0.0
-        pos.append(position)
-        dcs.append(_dice)
-        jis.append(_iou)
-        ppvs.append(_ppv)
-        tprs.append(_tpr)
-        avds.append(_avd)
+    context = lmc.PairContext.from_images(_pred, _truth)
+    pred = context.pred
+    overlap = context.overlap
+    n_truth = overlap.n_truth
+    lfdrs.append(overlap.lfdr(args.iou_threshold))
+    ltprs.append(overlap.ltpr(args.iou_threshold))
+    centers = scipy.ndimage.center_of_mass(
+        context.truth_mask, context.truth_labels, index=np.arange(1, n_truth + 1)
+    )
+    pos.extend(tuple(float(c) for c in np.round(ctr, decimals=2)) for ctr in centers)
+    # each truth lesion is compared to the union of the predicted lesions
+    # it intersects, so all terms follow from the overlap matrix
+    inter = overlap.truth_intersections()
+    other = overlap.truth_matched_pred_sizes()
+    size = overlap.truth_sizes
+    detected = inter > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dcs.extend(np.where(detected, 2 * inter / (size + other), 0.0).tolist())
+        jis.extend(np.where(detected, inter / (size + other - inter), 0.0).tolist())
+        ppvs.extend(np.where(detected, inter / other, 0.0).tolist())
+        tprs.extend(np.where(detected, inter / size, 0.0).tolist())
+        avds.extend(np.where(detected, np.abs(other - size) / size, 0.0).tolist())
+    truth_volume = lmv.SegmentationVolume(_truth)
+    lesion_volumes = truth_volume.lesion_volumes(labels=context.truth_labels)
+    lesion_vols.extend(lesion_volumes.volumes.tolist())
+    surface_distances = lms.lesion_surface_distances(
+        context.pred_labels,
+        context.truth_labels,
+        spacing=context.truth_spacing,
+        overlap=overlap,
+    )
+    assds.extend(sd.assd() for sd in surface_distances)
+    hd95s.extend(sd.hausdorff(95.0) for sd in surface_distances)
     pfns = lmcc.pad_with_none_to_length(pfns, n_truth)
     tfns = lmcc.pad_with_none_to_length(tfns, n_truth)
     dcs_summary = lmcc.summary_statistics(dcs)
@@ -129,6 +134,10 @@ def main(args: lmcc.ArgType = None) -> builtins.int:
     ppvs.extend(list(lmcc.summary_statistics(ppvs).values()))
     tprs.extend(list(lmcc.summary_statistics(tprs).values()))
     avds.extend(list(lmcc.summary_statistics(avds).values()))
+    lesion_vols.extend(list(lmcc.summary_statistics(lesion_vols).values()))
+    # undetected lesions have no surface distance (NaN); summarize the rest
+    assds.extend(list(_finite_summary_statistics(assds).values()))
+    hd95s.extend(list(_finite_summary_statistics(hd95s).values()))
     lfdrs = lmcc.pad_with_none_to_length(lfdrs, len(dcs))
     ltprs = lmcc.pad_with_none_to_length(ltprs, len(dcs))
     pred_vols = lmcc.pad_with_none_to_length(pred_vols, len(dcs))
@@ -145,6 +154,9 @@ def main(args: lmcc.ArgType = None) -> builtins.int:
         "PPV": ppvs,
         "TPR": tprs,
         "AVD": avds,
+        "ASSD": assds,
+        "HD95": hd95s,
+        "Lesion Vol.": lesion_vols,
         "LFDR": lfdrs,
         "LTPR": ltprs,
         "Pred. Vol.": pred_vols,
@@ -155,5 +167,12 @@ def main(args: lmcc.ArgType = None) -> builtins.int:
     return 0
 
 
+def _finite_summary_statistics(
+    data: typing.Sequence[builtins.float],
+) -> typing.Dict[builtins.str, builtins.float]:
+    finite = [d for d in data if np.isfinite(d)]
+    return lmcc.summary_statistics(finite or [float("nan")])
+
+
 if __name__ == "__main__":
     sys.exit(main())  # pragma: no cover
@@ -0,0 +1,118 @@
+"""Console script for the lesion volume of many segmentations."""
+import argparse
+import builtins
+import logging
+import pathlib
+import sys
+import typing
+import warnings
+
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    warnings.filterwarnings("ignore", category=UserWarning)
+    import pandas as pd
+
+    import lesion_metrics.cli.common as lmcc
+    import lesion_metrics.volume as lmv
+
+
+def arg_parser() -> argparse.ArgumentParser:
+    desc = (
+        "Calculate the lesion volume of a set of NIfTI binary (lesion) "
+        "segmentations, reading only the header and streaming the voxels."
+    )
+    parser = argparse.ArgumentParser(description=desc)
+
+    required = parser.add_argument_group("Required")
+    required.add_argument(
+        "paths",
+        type=lmcc.dir_or_file_path(),
+        nargs="+",
+        help="paths to segmentation images or directories of them",
+    )
+    required.add_argument(
+        "-o",
+        "--out-file",
+        type=lmcc.csv_file_path(),
+        required=True,
+        help="path to output csv file of results",
+    )
+
+    options = parser.add_argument_group("Optional")
+    options.add_argument(
+        "-u",
+        "--unit",
+        type=str,
+        choices=list(lmv.UnitOfVolume.__members__),
+        default="microliter",
+        help="unit of volume in the output",
+    )
+    options.add_argument(
+        "-cv",
+        "--chunk-voxels",
+        type=int,
+        default=lmv.CHUNK_VOXELS,
+        help=(
+            "number of voxels read (and thresholded) at once per image; "
+            "lower it to reduce the memory used per worker"
+        ),
+    )
+    options.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes (0 uses one per cpu)",
+    )
+    options.add_argument(
+        "-v",
+        "--verbosity",
+        action="count",
+        default=0,
+        help="increase output verbosity (e.g., -vv is more than -v)",
+    )
+    return parser
+
+
+def main(args: lmcc.ArgType = None) -> builtins.int:
+    """Console script for the lesion volume of many segmentations."""
+    if args is None:
+        parser = arg_parser()
+        args = parser.parse_args()
+    elif isinstance(args, list):
+        parser = arg_parser()
+        args = parser.parse_args(args)
+    lmcc.setup_log(args.verbosity)
+    logger = logging.getLogger(__name__)
+    if args.jobs < 0:
+        raise ValueError(f"--jobs must be non-negative. Got {args.jobs}.")
+    fns: typing.List[pathlib.Path] = []
+    for path in args.paths:
+        fns.extend(lmcc.glob_imgs(path) if path.is_dir() else [path])
+    if not fns:
+        raise ValueError("No images found in the given paths.")
+    unit = lmv.UnitOfVolume[args.unit]
+    if args.chunk_voxels < 1:
+        raise ValueError(f"--chunk-voxels must be positive. Got {args.chunk_voxels}.")
+    vols = lmv.streaming_volumes(
+        fns, unit, chunk_voxels=args.chunk_voxels, max_workers=args.jobs or None
+    )
+    names: typing.List[typing.Optional[builtins.str]] = []
+    for fn, vol in zip(fns, vols):
+        _, name, _ = lmcc.split_filename(fn)
+        names.append(name)
+        logger.info(f"Image: {name}; Volume: {vol:0.2f}")
+    vols_summary = lmcc.summary_statistics(vols)
+    names.extend(list(vols_summary.keys()))
+    vols.extend(list(vols_summary.values()))
+    out = {
+        "Image": names,
+        "Path": lmcc.pad_with_none_to_length([str(fn) for fn in fns], len(names)),
+        f"Volume ({args.unit})": vols,
+    }
+    pd.DataFrame(out).to_csv(args.out_file, index=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
@@ -0,0 +1,257 @@
+"""Shared intermediates for evaluating a pair of lesion segmentations
+
+a `PairContext` holds the binarized masks, their connected components,
+the confusion counts and the lesion overlap of one prediction/truth
+pair; each is computed at most once (and only when first needed), so
+any number of voxel- and lesion-wise metrics can be queried for the
+cost of one thresholding and one labeling of each mask
+
+metrics are requested by name (see `METRICS`); `plan` resolves the
+intermediates a set of metrics depends on, so, e.g., a dice-only
+evaluation never labels connected components
+"""
+
+from __future__ import annotations
+
+__all__ = [
+    "DEPENDENCIES",
+    "METRICS",
+    "MetricSpec",
+    "PairContext",
+    "evaluate",
+    "plan",
+]
+
+import builtins
+import dataclasses
+import functools
+import operator
+import typing
+
+import numpy as np
+import skimage.measure
+
+import lesion_metrics.metrics as lmm
+import lesion_metrics.surface as lms
+import lesion_metrics.typing as lmt
+from lesion_metrics.overlap import LesionOverlap
+from lesion_metrics.utils import binarize, to_numpy
+
+
+class PairContext:
+    """lazily computed, cached intermediates of one pred/truth pair
+
+    the truth's spacing (of the surface distances) and the (pred, truth)
+    voxel volumes (in microliters) default to those of the label images,
+    whose spacing must then have one entry per axis; `from_images` keeps
+    them for images whose singleton axes are squeezed out
+    """
+
+    def __init__(
+        self,
+        pred: lmt.Label,
+        truth: lmt.Label,
+        *,
+        spacing: typing.Optional[lms.Spacing] = None,
+        voxel_volumes: typing.Optional[
+            typing.Tuple[builtins.float, builtins.float]
+        ] = None,
+    ):
+        self.pred = pred
+        self.truth = truth
+        self._spacing = spacing
+        self._voxel_volumes = voxel_volumes
+
+    @classmethod
+    def from_images(cls, pred: lmt.Label, truth: lmt.Label) -> PairContext:
+        """context of the squeezed images with the spacing of the axes kept
+        and the voxel volumes of the images (incl. singleton axes)"""
+        voxel_volumes = (
+            _voxel_volume(lms.axis_spacing(pred)),
+            _voxel_volume(lms.axis_spacing(truth)),
+        )
+        pred, _ = lms.squeeze(pred)
+        truth, spacing = lms.squeeze(truth)
+        return cls(pred, truth, spacing=spacing, voxel_volumes=voxel_volumes)
+
+    @property
+    def truth_spacing(self) -> lms.Spacing:
+        if self._spacing is not None:
+            return self._spacing
+        return lms.spacing_of(self.truth, self.truth_mask.ndim)
+
+    @property
+    def voxel_volumes(self) -> typing.Tuple[builtins.float, builtins.float]:
+        """volume of a (pred, truth) voxel in microliters (1 w/o spacing)"""
+        if self._voxel_volumes is not None:
+            return self._voxel_volumes
+        pred_spacing = lms.spacing_of(self.pred, self.pred_mask.ndim)
+        return _voxel_volume(pred_spacing), _voxel_volume(self.truth_spacing)
+
+    @functools.cached_property
+    def pred_mask(self) -> np.ndarray:
+        return np.asarray(to_numpy(binarize(self.pred)))
+
+    @functools.cached_property
+    def truth_mask(self) -> np.ndarray:
+        return np.asarray(to_numpy(binarize(self.truth)))
+
+    @functools.cached_property
+    def pred_labels(self) -> np.ndarray:
+        """connected components of the prediction (0 is background)"""
+        labels: np.ndarray = skimage.measure.label(self.pred_mask)
+        return labels
+
+    @functools.cached_property
+    def truth_labels(self) -> np.ndarray:
+        """connected components of the truth (0 is background)"""
+        labels: np.ndarray = skimage.measure.label(self.truth_mask)
+        return labels
+
+    @functools.cached_property
+    def counts(self) -> lmm.ConfusionCounts:
+        return lmm.confusion_counts(self.pred_mask, self.truth_mask)
+
+    @functools.cached_property
+    def overlap(self) -> LesionOverlap:
+        return LesionOverlap.from_labels(self.pred_labels, self.truth_labels)
+
+    @functools.cached_property
+    def surface_distances(self) -> lms.SurfaceDistances:
+        """surface distances in the units of the truth's spacing (if any)"""
+        return lms.surface_distances(
+            self.pred_mask, self.truth_mask, spacing=self.truth_spacing
+        )
+
+    @property
+    def pred_count(self) -> builtins.int:
+        return int(self.pred_labels.max(initial=0))
+
+    @property
+    def truth_count(self) -> builtins.int:
+        return int(self.truth_labels.max(initial=0))
+
+    @property
+    def pred_volume(self) -> builtins.float:
+        """volume of the prediction in microliters (or voxels w/o spacing)"""
+        return self.counts.pred_count * self.voxel_volumes[0]
+
+    @property
+    def truth_volume(self) -> builtins.float:
+        """volume of the truth in microliters (or voxels w/o spacing)"""
+        return self.counts.truth_count * self.voxel_volumes[1]
+
+    def voxel_metrics(self) -> lmm.VoxelMetrics:
+        return lmm.VoxelMetrics.from_counts(self.counts)
+
+    def lfdr(self, iou_threshold: builtins.float = 0.0) -> builtins.float:
+        return self.overlap.lfdr(iou_threshold)
+
+    def ltpr(self, iou_threshold: builtins.float = 0.0) -> builtins.float:
+        return self.overlap.ltpr(iou_threshold)
+
+    def isbi15_score(
+        self,
+        *,
+        iou_threshold: builtins.float = 0.0,
+        reweighted: builtins.bool = True,
+    ) -> builtins.float:
+        return lmm.isbi15_score_from_metrics(
+            self.counts.dice(),
+            self.counts.ppv(),
+            self.lfdr(iou_threshold),
+            self.ltpr(iou_threshold),
+            reweighted=reweighted,
+        )
+
+    def evaluate(
+        self,
+        metrics: typing.Iterable[builtins.str],
+        *,
+        iou_threshold: builtins.float = 0.0,
+    ) -> typing.Dict[builtins.str, builtins.float]:
+        """the requested metrics (by name in `METRICS`), computing only
+        the intermediates in their `plan`, each once"""
+        names = list(dict.fromkeys(metrics))
+        for step in plan(names):
+            getattr(self, step)
+        return {name: METRICS[name].compute(self, iou_threshold) for name in names}
+
+
+def _voxel_volume(spacing: lms.Spacing) -> builtins.float:
+    return functools.reduce(operator.mul, spacing, 1.0)
+
+
+@dataclasses.dataclass(frozen=True)
+class MetricSpec:
+    """how to compute a metric from a `PairContext` (given the iou
+    threshold for lesion detection) and which intermediates it needs"""
+
+    compute: typing.Callable[[PairContext, builtins.float], builtins.float]
+    requires: typing.Tuple[builtins.str, ...]
+
+
+# intermediates (i.e., cached properties of `PairContext`) in the order in
+# which they can be computed and the intermediates each one depends on
+DEPENDENCIES: typing.Dict[builtins.str, typing.Tuple[builtins.str, ...]] = {
+    "pred_mask": (),
+    "truth_mask": (),
+    "counts": ("pred_mask", "truth_mask"),
+    "pred_labels": ("pred_mask",),
+    "truth_labels": ("truth_mask",),
+    "overlap": ("pred_labels", "truth_labels"),
+    "surface_distances": ("pred_mask", "truth_mask"),
+}
+
+METRICS: typing.Dict[builtins.str, MetricSpec] = {
+    "dice": MetricSpec(lambda c, _: c.counts.dice(), ("counts",)),
+    "jaccard": MetricSpec(lambda c, _: c.counts.jaccard(), ("counts",)),
+    "ppv": MetricSpec(lambda c, _: c.counts.ppv(), ("counts",)),
+    "tpr": MetricSpec(lambda c, _: c.counts.tpr(), ("counts",)),
+    "lfdr": MetricSpec(lambda c, t: c.lfdr(t), ("overlap",)),
+    "ltpr": MetricSpec(lambda c, t: c.ltpr(t), ("overlap",)),
+    "avd": MetricSpec(lambda c, _: c.counts.avd(), ("counts",)),
+    "isbi15_score": MetricSpec(
+        lambda c, t: c.isbi15_score(iou_threshold=t), ("counts", "overlap")
+    ),
+    "pred_volume": MetricSpec(lambda c, _: c.pred_volume, ("counts",)),
+    "truth_volume": MetricSpec(lambda c, _: c.truth_volume, ("counts",)),
+    "pred_count": MetricSpec(lambda c, _: c.pred_count, ("pred_labels",)),
+    "truth_count": MetricSpec(lambda c, _: c.truth_count, ("truth_labels",)),
+    "assd": MetricSpec(lambda c, _: c.surface_distances.assd(), ("surface_distances",)),
+    "hausdorff_distance": MetricSpec(
+        lambda c, _: c.surface_distances.hausdorff(), ("surface_distances",)
+    ),
+    "hd95": MetricSpec(
+        lambda c, _: c.surface_distances.hausdorff(95.0), ("surface_distances",)
+    ),
+}
+
+
+def plan(metrics: typing.Iterable[builtins.str]) -> typing.List[builtins.str]:
+    """intermediates needed for the metrics in the order they are computed"""
+    needed: typing.Set[builtins.str] = set()
+    stack: typing.List[builtins.str] = []
+    for name in metrics:
+        if name not in METRICS:
+            msg = f"Unknown metric: {name}. Expected one of {list(METRICS)}."
+            raise ValueError(msg)
+        stack.extend(METRICS[name].requires)
+    while stack:
+        step = stack.pop()
+        if step not in needed:
+            needed.add(step)
+            stack.extend(DEPENDENCIES[step])
+    return [step for step in DEPENDENCIES if step in needed]
+
+
+def evaluate(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    metrics: typing.Iterable[builtins.str],
+    *,
+    iou_threshold: builtins.float = 0.0,
+) -> typing.Dict[builtins.str, builtins.float]:
+    """the requested metrics (by name in `METRICS`) between a predicted and
+    true binary mask, computing only the intermediates the metrics need"""
+    return PairContext(pred, truth).evaluate(metrics, iou_threshold=iou_threshold)
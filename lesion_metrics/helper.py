@@ -6,12 +6,12 @@ from __future__ import annotations
 
 import builtins
 import dataclasses
+import typing
 
 import medio.image as mioi
 
-import lesion_metrics.metrics as lmm
+import lesion_metrics.context as lmc
 import lesion_metrics.typing as lmt
-import lesion_metrics.volume as lmv
 
 
 @dataclasses.dataclass
@@ -38,24 +38,27 @@ class Metrics:
         iou_threshold: builtins.float = 0.0
     ) -> Metrics:
         assert 0.0 <= iou_threshold < 1.0
-        pred = mioi.Image.from_path(pred_filename)
-        truth = mioi.Image.from_path(truth_filename)
-        _avd = lmm.avd(pred, truth)
-        dc = lmm.dice(pred, truth)
-        jc = lmm.jaccard(pred, truth)
-        __lfdr = lmm.lfdr(
-            pred, truth, iou_threshold=iou_threshold, return_pred_count=True
+        results: typing.Dict[builtins.str, typing.Any] = evaluate_filenames(
+            pred_filename,
+            truth_filename,
+            [field.name for field in dataclasses.fields(cls)],
+            iou_threshold=iou_threshold,
         )
-        assert isinstance(__lfdr, tuple)
-        _lfdr, np = __lfdr
-        __ltpr = lmm.ltpr(
-            pred, truth, iou_threshold=iou_threshold, return_truth_count=True
-        )
-        assert isinstance(__ltpr, tuple)
-        _ltpr, nt = __lfdr
-        _ppv = lmm.ppv(pred, truth)
-        _tpr = lmm.tpr(pred, truth)
-        isbi15 = lmm.isbi15_score_from_metrics(dc, _ppv, _lfdr, _ltpr)
-        vol_t = lmv.SegmentationVolume(truth).volume()
-        vol_p = lmv.SegmentationVolume(pred).volume()
-        return cls(_avd, dc, isbi15, jc, _lfdr, _ltpr, _ppv, _tpr, vol_t, vol_p, nt, np)
+        results["truth_count"] = int(results["truth_count"])
+        results["pred_count"] = int(results["pred_count"])
+        return cls(**results)
+
+
+def evaluate_filenames(
+    pred_filename: lmt.PathLike,
+    truth_filename: lmt.PathLike,
+    metrics: typing.Iterable[builtins.str],
+    *,
+    iou_threshold: builtins.float = 0.0,
+) -> typing.Dict[builtins.str, builtins.float]:
+    """only the requested metrics (see `lesion_metrics.context.METRICS`)
+    between a predicted and true segmentation image file"""
+    pred = mioi.Image.from_path(pred_filename)
+    truth = mioi.Image.from_path(truth_filename)
+    context = lmc.PairContext.from_images(pred, truth)
+    return context.evaluate(metrics, iou_threshold=iou_threshold)
@@ -3,91 +3,375 @@ Author: Jacob Reinhold (jacob.reinhold@jhu.edu)
 Created on: May 14, 2021
 """
 
+from __future__ import annotations
+
 __all__ = [
+    "ConfusionCounts",
+    "StackedConfusionCounts",
+    "VoxelMetrics",
     "assd",
     "avd",
+    "batch_avd",
+    "batch_confusion_counts",
+    "batch_dice",
+    "batch_jaccard",
+    "batch_ppv",
+    "batch_tpr",
+    "confusion_counts",
+    "confusion_counts_at_thresholds",
     "corr",
     "dice",
+    "hausdorff_distance",
+    "hd95",
     "iou_per_lesion",
     "isbi15_score",
     "isbi15_score_from_metrics",
     "jaccard",
     "lfdr",
+    "lfdr_curve",
     "ltpr",
+    "ltpr_curve",
+    "multiclass_confusion_counts",
+    "multiclass_confusion_matrix",
     "ppv",
+    "surface_dice",
     "tpr",
+    "voxel_metrics",
 ]
 
 import builtins
+import dataclasses
 import typing
 
+import numpy as np
+import scipy.ndimage
 import skimage.measure
 from scipy.stats import pearsonr
 
 import lesion_metrics.typing as lmt
-from lesion_metrics.utils import bbox, to_numpy
+from lesion_metrics.overlap import LesionOverlap
+from lesion_metrics.surface import (
+    hausdorff_from_points,
+    surface_distances,
+    surface_point_sets,
+)
+from lesion_metrics.utils import (
+    as_label_map,
+    binarize,
+    count_nonzero_in_bboxes,
+    count_nonzeros,
+    count_not_above,
+    numel,
+    to_numpy,
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class ConfusionCounts:
+    """voxel-wise confusion counts between predicted and true binary masks"""
+
+    tp: builtins.int
+    fp: builtins.int
+    fn: builtins.int
+    tn: builtins.int
+
+    @property
+    def pred_count(self) -> builtins.int:
+        return self.tp + self.fp
+
+    @property
+    def truth_count(self) -> builtins.int:
+        return self.tp + self.fn
+
+    def dice(self) -> builtins.float:
+        return _ratio(2 * self.tp, self.pred_count + self.truth_count)
+
+    def jaccard(self) -> builtins.float:
+        return _ratio(self.tp, self.tp + self.fp + self.fn)
+
+    def ppv(self) -> builtins.float:
+        return _ratio(self.tp, self.pred_count)
+
+    def tpr(self) -> builtins.float:
+        return _ratio(self.tp, self.truth_count)
+
+    def avd(self) -> builtins.float:
+        return _ratio(abs(self.pred_count - self.truth_count), self.truth_count)
+
+
+@dataclasses.dataclass(frozen=True)
+class VoxelMetrics:
+    """all voxel-wise metrics between predicted and true binary masks"""
+
+    avd: builtins.float
+    dice: builtins.float
+    jaccard: builtins.float
+    ppv: builtins.float
+    tpr: builtins.float
+
+    @classmethod
+    def from_counts(cls, counts: ConfusionCounts) -> VoxelMetrics:
+        return cls(
+            avd=counts.avd(),
+            dice=counts.dice(),
+            jaccard=counts.jaccard(),
+            ppv=counts.ppv(),
+            tpr=counts.tpr(),
+        )
+
+
+@dataclasses.dataclass(frozen=True)
+class StackedConfusionCounts:
+    """confusion counts for a stack of mask pairs (e.g., a batch), one per item"""
+
+    tp: np.ndarray
+    fp: np.ndarray
+    fn: np.ndarray
+    tn: np.ndarray
+
+    @property
+    def pred_count(self) -> np.ndarray:
+        count: np.ndarray = self.tp + self.fp
+        return count
+
+    @property
+    def truth_count(self) -> np.ndarray:
+        count: np.ndarray = self.tp + self.fn
+        return count
+
+    @classmethod
+    def from_confusion_matrix(cls, matrix: np.ndarray) -> StackedConfusionCounts:
+        """one-vs-rest counts per class from a (pred x truth) confusion matrix"""
+        tp = np.diagonal(matrix).copy()
+        fp = matrix.sum(axis=1) - tp
+        fn = matrix.sum(axis=0) - tp
+        tn = matrix.sum() - tp - fp - fn
+        return cls(tp=tp, fp=fp, fn=fn, tn=tn)
+
+    def __len__(self) -> builtins.int:
+        return len(self.tp)
+
+    def __getitem__(self, item: builtins.int) -> ConfusionCounts:
+        return ConfusionCounts(
+            tp=int(self.tp[item]),
+            fp=int(self.fp[item]),
+            fn=int(self.fn[item]),
+            tn=int(self.tn[item]),
+        )
+
+    def dice(self) -> np.ndarray:
+        return _ratios(2 * self.tp, self.pred_count + self.truth_count)
+
+    def jaccard(self) -> np.ndarray:
+        return _ratios(self.tp, self.tp + self.fp + self.fn)
+
+    def ppv(self) -> np.ndarray:
+        return _ratios(self.tp, self.pred_count)
+
+    def tpr(self) -> np.ndarray:
+        return _ratios(self.tp, self.truth_count)
+
+    def avd(self) -> np.ndarray:
+        return _ratios(np.abs(self.pred_count - self.truth_count), self.truth_count)
+
+
+def _ratio(numer: builtins.int, denom: builtins.int) -> builtins.float:
+    if denom == 0:
+        return lmt.NaN
+    return numer / denom
+
+
+def _ratios(numer: np.ndarray, denom: np.ndarray) -> np.ndarray:
+    out = np.full(np.shape(denom), lmt.NaN)
+    np.divide(numer, denom, out=out, where=denom != 0)
+    return out
+
+
+def confusion_counts(pred: lmt.Label, truth: lmt.Label) -> ConfusionCounts:
+    """tp/fp/fn/tn counts between predicted and true binary masks in one pass"""
+    p, t = binarize(pred), binarize(truth)
+    tp, n_pred, n_truth = count_nonzeros(p & t, p, t)
+    fp = n_pred - tp
+    fn = n_truth - tp
+    tn = numel(p) - tp - fp - fn
+    return ConfusionCounts(tp=tp, fp=fp, fn=fn, tn=tn)
+
+
+def batch_confusion_counts(pred: lmt.Label, truth: lmt.Label) -> StackedConfusionCounts:
+    """confusion counts per item of a batch of masks with shape (B, ...)
+
+    the spatial axes of all items are reduced in one vectorized operation
+    """
+    assert pred.ndim >= 2, "Batched masks require a leading batch axis."
+    p = np.asarray(to_numpy(pred > 0.0))
+    t = np.asarray(to_numpy(truth > 0.0))
+    assert p.shape == t.shape
+    spatial_axes = tuple(range(1, p.ndim))
+    tp = np.count_nonzero(p & t, axis=spatial_axes)
+    n_pred = np.count_nonzero(p, axis=spatial_axes)
+    n_truth = np.count_nonzero(t, axis=spatial_axes)
+    n_voxels = int(np.prod(p.shape[1:]))
+    fp = n_pred - tp
+    fn = n_truth - tp
+    tn = n_voxels - tp - fp - fn
+    return StackedConfusionCounts(tp=tp, fp=fp, fn=fn, tn=tn)
+
+
+def confusion_counts_at_thresholds(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    thresholds: typing.Optional[typing.Sequence[builtins.float]] = None,
+    *,
+    n_bins: typing.Optional[builtins.int] = None,
+    chunk_size: builtins.int = 2**22,
+) -> StackedConfusionCounts:
+    """confusion counts of a probabilistic prediction at each threshold
+
+    the prediction is binarized as `pred > threshold`; provide either
+    the `thresholds` or `n_bins` for evenly spaced thresholds in [0, 1).
+    a joint histogram of the prediction (binned by the thresholds) and
+    the truth is built in one pass and the counts at every threshold are
+    read off of its cumulative sums, so the cost barely depends on the
+    number of thresholds.
+    """
+    if (thresholds is None) == (n_bins is None):
+        raise ValueError("Provide exactly one of `thresholds` or `n_bins`.")
+    if n_bins is not None:
+        _thresholds = np.arange(n_bins) / n_bins
+    else:
+        _thresholds = np.asarray(thresholds, dtype=np.float64)
+    order = np.argsort(_thresholds, kind="stable")
+    sorted_thresholds = _thresholds[order]
+    n_thresholds = sorted_thresholds.size
+    p = np.asarray(to_numpy(pred)).reshape(-1)
+    t = np.asarray(to_numpy(truth > 0.0)).reshape(-1)
+    assert p.size == t.size
+    pred_hist = np.zeros(n_thresholds + 1, dtype=np.int64)
+    tp_hist = np.zeros(n_thresholds + 1, dtype=np.int64)
+    for start in range(0, p.size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        # number of thresholds strictly below each value, i.e., the
+        # value is positive at the first `n_below` sorted thresholds
+        n_below = np.searchsorted(sorted_thresholds, p[chunk], side="left")
+        pred_hist += np.bincount(n_below, minlength=n_thresholds + 1)
+        tp_hist += np.bincount(n_below[t[chunk]], minlength=n_thresholds + 1)
+    n_pred = p.size - np.cumsum(pred_hist)[:-1]
+    tp = int(tp_hist.sum()) - np.cumsum(tp_hist)[:-1]
+    n_truth = int(tp_hist.sum())
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(n_thresholds)
+    tp, n_pred = tp[inverse], n_pred[inverse]
+    fp = n_pred - tp
+    fn = n_truth - tp
+    tn = p.size - tp - fp - fn
+    return StackedConfusionCounts(tp=tp, fp=fp, fn=fn, tn=tn)
+
+
+def multiclass_confusion_matrix(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    n_classes: typing.Optional[builtins.int] = None,
+) -> np.ndarray:
+    """K x K confusion matrix between integer label maps (rows are pred)
+
+    computed with a single bincount over `pred * K + truth`; label 0
+    is the background class and `n_classes` defaults to the largest
+    label plus one
+    """
+    p, t = as_label_map(pred).ravel(), as_label_map(truth).ravel()
+    assert p.size == t.size
+    largest = int(max(p.max(initial=0), t.max(initial=0)))
+    if n_classes is None:
+        n_classes = largest + 1
+    elif largest >= n_classes:
+        raise ValueError(f"Label maps contain labels >= n_classes ({n_classes}).")
+    joint = p * n_classes
+    joint += t
+    matrix = np.bincount(joint, minlength=n_classes**2)
+    confusion: np.ndarray = matrix.reshape(n_classes, n_classes)
+    return confusion
+
+
+def multiclass_confusion_counts(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    n_classes: typing.Optional[builtins.int] = None,
+) -> StackedConfusionCounts:
+    """one-vs-rest confusion counts for each class (incl. background at 0)"""
+    matrix = multiclass_confusion_matrix(pred, truth, n_classes)
+    return StackedConfusionCounts.from_confusion_matrix(matrix)
+
+
+def voxel_metrics(pred: lmt.Label, truth: lmt.Label) -> VoxelMetrics:
+    """avd, dice, jaccard, ppv and tpr from one set of confusion counts"""
+    return VoxelMetrics.from_counts(confusion_counts(pred, truth))
 
 
 def dice(pred: lmt.Label, truth: lmt.Label) -> builtins.float:
     """dice coefficient between predicted and true binary masks"""
-    p, t = (pred > 0.0), (truth > 0.0)
-    intersection = (p & t).sum()
-    cardinality = p.sum() + t.sum()
-    if cardinality == 0.0:
-        return lmt.NaN
-    score: float = 2 * intersection / cardinality
-    return score
+    return confusion_counts(pred, truth).dice()
 
 
 def jaccard(pred: lmt.Label, truth: lmt.Label) -> builtins.float:
     """jaccard index (IoU) between predicted and true binary masks"""
-    p, t = (pred > 0.0), (truth > 0.0)
-    intersection = (p & t).sum()
-    union = (p | t).sum()
-    if union == 0.0:
-        return lmt.NaN
-    score: float = intersection / union
-    return score
+    return confusion_counts(pred, truth).jaccard()
 
 
 def ppv(pred: lmt.Label, truth: lmt.Label) -> builtins.float:
     """positive predictive value (precision) btwn predicted and true binary masks"""
-    p, t = (pred > 0.0), (truth > 0.0)
-    intersection = (p & t).sum()
-    denom = p.sum()
-    if denom == 0.0:
-        return lmt.NaN
-    score: float = intersection / denom
-    return score
+    return confusion_counts(pred, truth).ppv()
 
 
 def tpr(pred: lmt.Label, truth: lmt.Label) -> builtins.float:
     """true positive rate (sensitivity) between predicted and true binary masks"""
-    p, t = (pred > 0.0), (truth > 0.0)
-    intersection = (p & t).sum()
-    denom = t.sum()
-    if denom == 0.0:
-        return lmt.NaN
-    score: float = intersection / denom
-    return score
+    return confusion_counts(pred, truth).tpr()
+
+
+def batch_dice(pred: lmt.Label, truth: lmt.Label) -> np.ndarray:
+    """dice coefficient of each item in a batch of masks with shape (B, ...)"""
+    return batch_confusion_counts(pred, truth).dice()
+
+
+def batch_jaccard(pred: lmt.Label, truth: lmt.Label) -> np.ndarray:
+    """jaccard index of each item in a batch of masks with shape (B, ...)"""
+    return batch_confusion_counts(pred, truth).jaccard()
+
+
+def batch_ppv(pred: lmt.Label, truth: lmt.Label) -> np.ndarray:
+    """positive predictive value of each item in a batch with shape (B, ...)"""
+    return batch_confusion_counts(pred, truth).ppv()
+
+
+def batch_tpr(pred: lmt.Label, truth: lmt.Label) -> np.ndarray:
+    """true positive rate of each item in a batch of masks with shape (B, ...)"""
+    return batch_confusion_counts(pred, truth).tpr()
 
 
-IoUs = typing.List[builtins.float]
+def batch_avd(pred: lmt.Label, truth: lmt.Label) -> np.ndarray:
+    """absolute volume difference of each item in a batch with shape (B, ...)"""
+    return batch_confusion_counts(pred, truth).avd()
+
+
+IoUs = np.ndarray
 
 
 def iou_per_lesion(
     target: lmt.Label, other: lmt.Label, *, return_count: builtins.bool = False
 ) -> typing.Union[IoUs, typing.Tuple[IoUs, builtins.int]]:
-    """iou of each lesion using target as reference"""
-    t, o = (target > 0.0), (other > 0.0)
+    """iou of each lesion using target as reference
+
+    the iou of a lesion is computed within the lesion's bounding box,
+    i.e., the union includes all `other` voxels inside the bounding box
+    """
+    t, o = binarize(target), binarize(other)
+    t, o = to_numpy(t), to_numpy(o)
     cc, n = skimage.measure.label(t, return_num=True)
-    ious: typing.List[builtins.float] = []
-    for i in range(1, n + 1):
-        target_lesion_whole_array = cc == i
-        lesion_bbox = tuple(bbox(target_lesion_whole_array))
-        target_lesion = target_lesion_whole_array[lesion_bbox]
-        other_lesion = o[lesion_bbox]
-        ious.append(jaccard(other_lesion, target_lesion))
+    sizes = np.bincount(cc.ravel(), minlength=n + 1)[1:]
+    intersections = np.bincount(cc[o], minlength=n + 1)[1:]
+    lesion_bboxes = scipy.ndimage.find_objects(cc, max_label=n)
+    other_in_bboxes = count_nonzero_in_bboxes(o, lesion_bboxes)
+    unions = sizes + other_in_bboxes - intersections
+    ious: IoUs = intersections / np.maximum(unions, 1)
     if return_count:
         return ious, n
     else:
@@ -103,17 +387,11 @@ def lfdr(
 ) -> typing.Union[builtins.float, typing.Tuple[builtins.float, builtins.int]]:
     """lesion false discovery rate between predicted and true binary masks"""
     assert 0.0 <= iou_threshold <= 1.0
-    p, t = (pred > 0.0), (truth > 0.0)
-    p, t = to_numpy(p), to_numpy(t)
-    ious, n_pred = iou_per_lesion(p, t, return_count=True)
-    assert isinstance(ious, list)
+    ious, n_pred = iou_per_lesion(pred, truth, return_count=True)
+    assert isinstance(ious, np.ndarray)
     assert isinstance(n_pred, int)
-    if not ious:
-        return lmt.NaN
-    false_positives = [iou <= iou_threshold for iou in ious]
-    fp = sum(false_positives)
-    fp_plus_tp = len(false_positives)
-    score: float = fp / fp_plus_tp
+    fp = int(np.count_nonzero(ious <= iou_threshold))
+    score = _ratio(fp, n_pred)
     if return_pred_count:
         return score, n_pred
     else:
@@ -129,37 +407,111 @@ def ltpr(
 ) -> typing.Union[builtins.float, typing.Tuple[builtins.float, builtins.int]]:
     """lesion true positive rate between predicted and true binary masks"""
     assert 0.0 <= iou_threshold <= 1.0
-    p, t = (pred > 0.0), (truth > 0.0)
-    p, t = to_numpy(p), to_numpy(t)
-    ious, n_truth = iou_per_lesion(t, p, return_count=True)
-    assert isinstance(ious, list)
+    ious, n_truth = iou_per_lesion(truth, pred, return_count=True)
+    assert isinstance(ious, np.ndarray)
     assert isinstance(n_truth, int)
-    if not ious:
-        return lmt.NaN
-    true_positives = [iou > iou_threshold for iou in ious]
-    tp = sum(true_positives)
-    tp_plus_fp = len(true_positives)
-    score: float = tp / tp_plus_fp
+    tp = int(np.count_nonzero(ious > iou_threshold))
+    score = _ratio(tp, n_truth)
     if return_truth_count:
         return score, n_truth
     else:
         return score
 
 
+def lfdr_curve(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    iou_thresholds: typing.Sequence[builtins.float],
+) -> np.ndarray:
+    """lesion false discovery rate at each of several iou thresholds"""
+    assert all(0.0 <= thresh <= 1.0 for thresh in iou_thresholds)
+    ious, n_pred = iou_per_lesion(pred, truth, return_count=True)
+    assert isinstance(ious, np.ndarray)
+    assert isinstance(n_pred, int)
+    fp = count_not_above(ious, iou_thresholds)
+    scores: np.ndarray = fp / n_pred if n_pred else np.full(fp.shape, lmt.NaN)
+    return scores
+
+
+def ltpr_curve(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    iou_thresholds: typing.Sequence[builtins.float],
+) -> np.ndarray:
+    """lesion true positive rate at each of several iou thresholds"""
+    assert all(0.0 <= thresh <= 1.0 for thresh in iou_thresholds)
+    ious, n_truth = iou_per_lesion(truth, pred, return_count=True)
+    assert isinstance(ious, np.ndarray)
+    assert isinstance(n_truth, int)
+    tp = n_truth - count_not_above(ious, iou_thresholds)
+    scores: np.ndarray = tp / n_truth if n_truth else np.full(tp.shape, lmt.NaN)
+    return scores
+
+
 def avd(pred: lmt.Label, truth: lmt.Label) -> builtins.float:
     """absolute volume difference between predicted and true binary masks"""
-    p, t = (pred > 0.0), (truth > 0.0)
-    numer = abs(p.sum() - t.sum())
-    denom = t.sum()
-    if denom == 0.0:
-        return lmt.NaN
-    score: float = numer / denom
-    return score
+    return confusion_counts(pred, truth).avd()
 
 
-def assd(pred: lmt.Label, truth: lmt.Label) -> float:
-    """average symmetric surface difference between predicted and true binary masks"""
-    raise NotImplementedError
+def assd(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    *,
+    spacing: typing.Optional[typing.Sequence[builtins.float]] = None,
+) -> builtins.float:
+    """average symmetric surface distance between predicted and true binary masks
+
+    distances are in physical units given by `spacing` (defaults to the
+    `spacing` attribute of the truth if available, otherwise voxels)
+    """
+    return surface_distances(pred, truth, spacing=spacing).assd()
+
+
+def hausdorff_distance(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    *,
+    spacing: typing.Optional[typing.Sequence[builtins.float]] = None,
+    method: builtins.str = "edt",
+) -> builtins.float:
+    """hausdorff distance between predicted and true binary masks
+
+    method `kdtree` runs an exact early-break nearest-neighbor search over
+    the surface points, which needs far less memory than distance
+    transforms (method `edt`) on large, high-resolution masks
+    """
+    if method == "kdtree":
+        points = surface_point_sets(pred, truth, spacing=spacing)
+        hd, _ = hausdorff_from_points(*points)
+        return hd
+    return surface_distances(pred, truth, spacing=spacing, method=method).hausdorff()
+
+
+def hd95(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    *,
+    spacing: typing.Optional[typing.Sequence[builtins.float]] = None,
+    method: builtins.str = "edt",
+) -> builtins.float:
+    """95th percentile hausdorff distance between predicted and true binary masks"""
+    distances = surface_distances(pred, truth, spacing=spacing, method=method)
+    return distances.hausdorff(95.0)
+
+
+def surface_dice(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    tolerances: typing.Sequence[builtins.float],
+    *,
+    spacing: typing.Optional[typing.Sequence[builtins.float]] = None,
+) -> np.ndarray:
+    """normalized surface dice between predicted and true binary masks at
+    each tolerance (in the physical units of `spacing`)
+
+    the surface distances are computed once for all the tolerances
+    """
+    return surface_distances(pred, truth, spacing=spacing).surface_dice(tolerances)
 
 
 # https://www.python.org/dev/peps/pep-0484/#the-numeric-tower
@@ -188,12 +540,14 @@ def isbi15_score(
             lesion segmentation: resource and challenge." NeuroImage
             148 (2017): 77-102.
     """
-    _lfdr = lfdr(pred, truth)
-    assert isinstance(_lfdr, float)
-    _ltpr = ltpr(pred, truth)
-    assert isinstance(_ltpr, float)
+    overlap = LesionOverlap.from_masks(pred, truth)
+    counts = confusion_counts(pred, truth)
     score = isbi15_score_from_metrics(
-        dice(pred, truth), ppv(pred, truth), _lfdr, _ltpr, reweighted=reweighted
+        counts.dice(),
+        counts.ppv(),
+        overlap.lfdr(),
+        overlap.ltpr(),
+        reweighted=reweighted,
     )
     return score
 
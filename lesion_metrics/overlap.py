@@ -0,0 +1,190 @@
+"""Overlap between predicted and true lesions
+
+sparse pred x truth lesion intersection matrix built once per
+pair of label images from which lesion-wise metrics are queried
+"""
+
+from __future__ import annotations
+
+__all__ = [
+    "LesionOverlap",
+    "lesion_overlap_per_class",
+]
+
+import builtins
+import dataclasses
+import typing
+
+import numpy as np
+import scipy.ndimage
+import scipy.sparse
+import skimage.measure
+
+import lesion_metrics.typing as lmt
+from lesion_metrics.utils import (
+    as_label_map,
+    binarize,
+    count_nonzero_in_bboxes,
+    count_not_above,
+    to_numpy,
+)
+
+
+@dataclasses.dataclass(frozen=True)
+class LesionOverlap:
+    """voxel overlap between every predicted and every true lesion
+
+    `intersection[i, j]` is the number of voxels shared by predicted
+    lesion i + 1 and true lesion j + 1 (component labels start at 1).
+    the per-lesion iou uses the lesion's bounding box as the context,
+    i.e., the union includes all voxels of the other mask in the box,
+    which matches `lesion_metrics.metrics.iou_per_lesion`.
+    """
+
+    intersection: scipy.sparse.csr_matrix
+    pred_sizes: np.ndarray
+    truth_sizes: np.ndarray
+    truth_in_pred_bboxes: np.ndarray
+    pred_in_truth_bboxes: np.ndarray
+
+    @classmethod
+    def from_labels(
+        cls, pred_labels: np.ndarray, truth_labels: np.ndarray
+    ) -> LesionOverlap:
+        """build from connected-component label images (0 is background)"""
+        assert pred_labels.shape == truth_labels.shape
+        n_pred = int(pred_labels.max(initial=0))
+        n_truth = int(truth_labels.max(initial=0))
+        both = (pred_labels > 0) & (truth_labels > 0)
+        rows = pred_labels[both].astype(np.int64) - 1
+        cols = truth_labels[both].astype(np.int64) - 1
+        ones = np.ones(rows.size, dtype=np.int64)
+        shape = (n_pred, n_truth)
+        # duplicate (row, col) entries are summed in the conversion to csr
+        intersection = scipy.sparse.coo_matrix((ones, (rows, cols)), shape=shape)
+        pred_bboxes = scipy.ndimage.find_objects(pred_labels, max_label=n_pred)
+        truth_bboxes = scipy.ndimage.find_objects(truth_labels, max_label=n_truth)
+        return cls(
+            intersection=intersection.tocsr(),
+            pred_sizes=np.bincount(pred_labels.ravel(), minlength=n_pred + 1)[1:],
+            truth_sizes=np.bincount(truth_labels.ravel(), minlength=n_truth + 1)[1:],
+            truth_in_pred_bboxes=count_nonzero_in_bboxes(truth_labels, pred_bboxes),
+            pred_in_truth_bboxes=count_nonzero_in_bboxes(pred_labels, truth_bboxes),
+        )
+
+    @classmethod
+    def from_masks(cls, pred: lmt.Label, truth: lmt.Label) -> LesionOverlap:
+        """label the connected components of binary masks and build"""
+        p, t = to_numpy(binarize(pred)), to_numpy(binarize(truth))
+        return cls.from_labels(skimage.measure.label(p), skimage.measure.label(t))
+
+    @property
+    def n_pred(self) -> builtins.int:
+        return int(self.intersection.shape[0])
+
+    @property
+    def n_truth(self) -> builtins.int:
+        return int(self.intersection.shape[1])
+
+    def pred_intersections(self) -> np.ndarray:
+        """number of truth voxels in each predicted lesion"""
+        return np.asarray(self.intersection.sum(axis=1)).ravel()
+
+    def truth_intersections(self) -> np.ndarray:
+        """number of predicted voxels in each true lesion"""
+        return np.asarray(self.intersection.sum(axis=0)).ravel()
+
+    def truth_matched_pred_sizes(self) -> np.ndarray:
+        """total size of the predicted lesions intersecting each true lesion"""
+        overlapping = (self.intersection > 0).astype(np.int64)
+        return np.asarray(overlapping.T @ self.pred_sizes).ravel()
+
+    def pred_ious(self) -> np.ndarray:
+        """iou of each predicted lesion using the truth as the other mask"""
+        inter = self.pred_intersections()
+        union = self.pred_sizes + self.truth_in_pred_bboxes - inter
+        ious: np.ndarray = inter / np.maximum(union, 1)
+        return ious
+
+    def truth_ious(self) -> np.ndarray:
+        """iou of each true lesion using the prediction as the other mask"""
+        inter = self.truth_intersections()
+        union = self.truth_sizes + self.pred_in_truth_bboxes - inter
+        ious: np.ndarray = inter / np.maximum(union, 1)
+        return ious
+
+    def pred_dice(self) -> np.ndarray:
+        """dice of each predicted lesion using the truth as the other mask"""
+        inter = self.pred_intersections()
+        denom = self.pred_sizes + self.truth_in_pred_bboxes
+        dice: np.ndarray = 2 * inter / np.maximum(denom, 1)
+        return dice
+
+    def truth_dice(self) -> np.ndarray:
+        """dice of each true lesion using the prediction as the other mask"""
+        inter = self.truth_intersections()
+        denom = self.truth_sizes + self.pred_in_truth_bboxes
+        dice: np.ndarray = 2 * inter / np.maximum(denom, 1)
+        return dice
+
+    def lfdr(self, iou_threshold: builtins.float = 0.0) -> builtins.float:
+        """lesion false discovery rate"""
+        assert 0.0 <= iou_threshold <= 1.0
+        if self.n_pred == 0:
+            return lmt.NaN
+        fp = np.count_nonzero(self.pred_ious() <= iou_threshold)
+        return fp / self.n_pred
+
+    def ltpr(self, iou_threshold: builtins.float = 0.0) -> builtins.float:
+        """lesion true positive rate"""
+        assert 0.0 <= iou_threshold <= 1.0
+        if self.n_truth == 0:
+            return lmt.NaN
+        tp = np.count_nonzero(self.truth_ious() > iou_threshold)
+        return tp / self.n_truth
+
+    def lfdr_curve(self, iou_thresholds: typing.Sequence[builtins.float]) -> np.ndarray:
+        """lesion false discovery rate at each iou threshold"""
+        return _rate(count_not_above(self.pred_ious(), iou_thresholds), self.n_pred)
+
+    def ltpr_curve(self, iou_thresholds: typing.Sequence[builtins.float]) -> np.ndarray:
+        """lesion true positive rate at each iou threshold"""
+        tp = self.n_truth - count_not_above(self.truth_ious(), iou_thresholds)
+        return _rate(tp, self.n_truth)
+
+    def splits(self) -> np.ndarray:
+        """labels of true lesions overlapped by more than one predicted lesion"""
+        n_overlapping = np.diff(self.intersection.tocsc().indptr)
+        return np.flatnonzero(n_overlapping > 1) + 1
+
+    def merges(self) -> np.ndarray:
+        """labels of predicted lesions overlapping more than one true lesion"""
+        n_overlapping = np.diff(self.intersection.indptr)
+        return np.flatnonzero(n_overlapping > 1) + 1
+
+
+def lesion_overlap_per_class(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    classes: typing.Optional[typing.Sequence[builtins.int]] = None,
+) -> typing.Dict[builtins.int, LesionOverlap]:
+    """lesion overlap of each (non-background) class of two label maps
+
+    each class mask of each label map is labeled exactly once; `classes`
+    defaults to every label from 1 to the largest label present
+    """
+    p, t = as_label_map(pred), as_label_map(truth)
+    if classes is None:
+        n_classes = int(max(p.max(initial=0), t.max(initial=0))) + 1
+        classes = range(1, n_classes)
+    overlaps: typing.Dict[builtins.int, LesionOverlap] = {}
+    for k in classes:
+        overlaps[k] = LesionOverlap.from_masks(p == k, t == k)
+    return overlaps
+
+
+def _rate(counts: np.ndarray, total: builtins.int) -> np.ndarray:
+    if total == 0:
+        return np.full(counts.shape, lmt.NaN)
+    rates: np.ndarray = counts / total
+    return rates
@@ -0,0 +1,338 @@
+"""Surface distances between lesion segmentations
+
+surfaces are extracted once per mask and the euclidean distance
+transforms only run on the bounding box of the union of the masks
+(plus a margin), which is a small fraction of the image for lesions
+"""
+
+from __future__ import annotations
+
+__all__ = [
+    "SurfaceDistances",
+    "axis_spacing",
+    "crop_to_union",
+    "directed_hausdorff",
+    "hausdorff_from_points",
+    "lesion_surface_distances",
+    "spacing_of",
+    "squeeze",
+    "surface",
+    "surface_distances",
+    "surface_point_sets",
+    "surface_points",
+]
+
+import builtins
+import dataclasses
+import typing
+
+import numpy as np
+import scipy.ndimage
+import scipy.spatial
+
+import lesion_metrics.typing as lmt
+from lesion_metrics.overlap import LesionOverlap
+from lesion_metrics.utils import binarize, count_not_above, to_numpy
+
+Spacing = typing.Tuple[builtins.float, ...]
+
+
+@dataclasses.dataclass(frozen=True)
+class SurfaceDistances:
+    """distances (in physical units) from each surface voxel of one mask
+    to the nearest surface voxel of the other mask"""
+
+    pred_to_truth: np.ndarray
+    truth_to_pred: np.ndarray
+
+    @property
+    def is_empty(self) -> builtins.bool:
+        return self.pred_to_truth.size == 0 or self.truth_to_pred.size == 0
+
+    def assd(self) -> builtins.float:
+        """average symmetric surface distance"""
+        if self.is_empty:
+            return lmt.NaN
+        total = self.pred_to_truth.sum() + self.truth_to_pred.sum()
+        n = self.pred_to_truth.size + self.truth_to_pred.size
+        return float(total / n)
+
+    def hausdorff(self, percentile: builtins.float = 100.0) -> builtins.float:
+        """(percentile) hausdorff distance, i.e., the larger of the
+        directed percentile distances; 100 is the maximum distance"""
+        if self.is_empty:
+            return lmt.NaN
+        if percentile == 100.0:
+            return float(max(self.pred_to_truth.max(), self.truth_to_pred.max()))
+        pt = np.percentile(self.pred_to_truth, percentile)
+        tp = np.percentile(self.truth_to_pred, percentile)
+        return float(max(pt, tp))
+
+    def surface_dice(self, tolerances: typing.Sequence[builtins.float]) -> np.ndarray:
+        """normalized surface dice at each tolerance, i.e., the fraction of
+        surface voxels of both masks within the tolerance of the other surface;
+        every tolerance is read off one sort of each distance array"""
+        if self.is_empty:
+            return np.full(len(tolerances), lmt.NaN)
+        close = count_not_above(self.pred_to_truth, tolerances)
+        close += count_not_above(self.truth_to_pred, tolerances)
+        n = self.pred_to_truth.size + self.truth_to_pred.size
+        dice: np.ndarray = close / n
+        return dice
+
+
+def spacing_of(label: lmt.Label, ndim: builtins.int) -> Spacing:
+    """voxel spacing of a label image (unit spacing if it has none); the
+    spacing must have `ndim` entries, e.g., a squeezed medio image keeps
+    the spacing of its singleton axes, so use `squeeze` to drop them"""
+    spacing = getattr(label, "spacing", None)
+    if spacing is None:
+        return (1.0,) * ndim
+    spacing = tuple(float(s) for s in spacing)
+    if len(spacing) != ndim:
+        raise ValueError(f"Spacing {spacing} does not match {ndim} dimensions.")
+    return spacing
+
+
+def axis_spacing(label: lmt.Label) -> Spacing:
+    """spacing of every axis of a label image; axes past its spacing
+    (e.g., time) and images without spacing have unit spacing"""
+    spacing = getattr(label, "spacing", None)
+    spacing = () if spacing is None else tuple(float(s) for s in spacing)
+    if len(spacing) > label.ndim:
+        raise ValueError(f"Spacing {spacing} does not match {label.ndim} dimensions.")
+    return spacing + (1.0,) * (label.ndim - len(spacing))
+
+
+def squeeze(label: lmt.Label) -> typing.Tuple[lmt.Label, Spacing]:
+    """label image without its singleton axes and the spacing of the axes
+    kept (the spacing of an image, e.g., a medio image, keeps all its axes
+    when squeezed)"""
+    kept = tuple(s for s, n in zip(axis_spacing(label), label.shape) if n != 1)
+    return label.squeeze(), kept
+
+
+def surface(mask: np.ndarray) -> np.ndarray:
+    """boolean image of the voxels of a binary mask which touch the background
+    (face connectivity); voxels on the image border are always surface"""
+    structure = scipy.ndimage.generate_binary_structure(mask.ndim, 1)
+    eroded = scipy.ndimage.binary_erosion(mask, structure, border_value=0)
+    border: np.ndarray = mask & ~eroded
+    return border
+
+
+def crop_to_union(
+    *masks: np.ndarray, margin: builtins.int = 1
+) -> typing.Optional[typing.Tuple[builtins.slice, ...]]:
+    """bounding box of the union of the masks (plus a margin, clipped to the
+    image) or None if all the masks are empty"""
+    union = masks[0].copy()
+    for mask in masks[1:]:
+        union |= mask
+    bbox = scipy.ndimage.find_objects(union.view(np.uint8), max_label=1)[0]
+    if bbox is None:
+        return None
+    return tuple(
+        builtins.slice(max(s.start - margin, 0), min(s.stop + margin, n))
+        for s, n in zip(bbox, union.shape)
+    )
+
+
+def _cropped_surfaces(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    spacing: typing.Optional[typing.Sequence[builtins.float]],
+    margin: builtins.int,
+) -> typing.Optional[typing.Tuple[np.ndarray, np.ndarray, Spacing]]:
+    """surfaces of both masks in the union bounding box (None if either
+    surface is empty) and the voxel spacing"""
+    p = np.asarray(to_numpy(binarize(pred)))
+    t = np.asarray(to_numpy(binarize(truth)))
+    assert p.shape == t.shape
+    _spacing = spacing_of(truth, t.ndim) if spacing is None else tuple(spacing)
+    bbox = crop_to_union(p, t, margin=margin)
+    if bbox is None:
+        return None
+    p_surface, t_surface = surface(p[bbox]), surface(t[bbox])
+    if not p_surface.any() or not t_surface.any():
+        return None
+    return p_surface, t_surface, _spacing
+
+
+def surface_distances(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    *,
+    spacing: typing.Optional[typing.Sequence[builtins.float]] = None,
+    margin: builtins.int = 1,
+    method: builtins.str = "edt",
+) -> SurfaceDistances:
+    """symmetric surface distances between predicted and true binary masks
+
+    spacing defaults to the `spacing` attribute of the truth (if any).
+    with method `edt`, the distance transforms are computed on the union
+    bounding box, which is exact since every surface voxel lies inside it;
+    with method `kdtree`, nearest surface points are found with k-d trees,
+    which avoids the (float) distance images for large, high-res masks
+    """
+    if method not in ("edt", "kdtree"):
+        raise ValueError(f"Invalid method: {method}. Expected 'edt' or 'kdtree'.")
+    surfaces = _cropped_surfaces(pred, truth, spacing, margin)
+    if surfaces is None:
+        return SurfaceDistances(np.zeros(0), np.zeros(0))
+    p_surface, t_surface, _spacing = surfaces
+    if method == "kdtree":
+        p_points = surface_points(p_surface, _spacing)
+        t_points = surface_points(t_surface, _spacing)
+        dist_to_t, _ = scipy.spatial.cKDTree(t_points).query(p_points, workers=-1)
+        dist_to_p, _ = scipy.spatial.cKDTree(p_points).query(t_points, workers=-1)
+        return SurfaceDistances(dist_to_t, dist_to_p)
+    dist_to_t = scipy.ndimage.distance_transform_edt(~t_surface, sampling=_spacing)
+    dist_to_p = scipy.ndimage.distance_transform_edt(~p_surface, sampling=_spacing)
+    return SurfaceDistances(dist_to_t[p_surface], dist_to_p[t_surface])
+
+
+def lesion_surface_distances(
+    pred_labels: np.ndarray,
+    truth_labels: np.ndarray,
+    *,
+    spacing: typing.Optional[typing.Sequence[builtins.float]] = None,
+    margin: builtins.int = 1,
+    overlap: typing.Optional[LesionOverlap] = None,
+) -> typing.List[SurfaceDistances]:
+    """surface distances of each true lesion to the predicted lesions
+    which intersect it (empty if the lesion is undetected)
+
+    each mask's surface gets one distance transform (on the union bounding
+    box); each lesion then only reads the distances of its own surface voxels
+    in its `find_objects` box, with the lesion membership of each surface
+    voxel taken from the component labels. distances are measured to the
+    nearest surface voxel of the other mask.
+    """
+    assert pred_labels.shape == truth_labels.shape
+    if overlap is None:
+        overlap = LesionOverlap.from_labels(pred_labels, truth_labels)
+    empty = SurfaceDistances(np.zeros(0), np.zeros(0))
+    distances = [empty] * overlap.n_truth
+    _spacing = (1.0,) * pred_labels.ndim if spacing is None else tuple(spacing)
+    bbox = crop_to_union(pred_labels > 0, truth_labels > 0, margin=margin)
+    if bbox is None:
+        return distances
+    p_labels, t_labels = pred_labels[bbox], truth_labels[bbox]
+    p_surface, t_surface = surface(p_labels > 0), surface(t_labels > 0)
+    if not p_surface.any() or not t_surface.any():
+        return distances
+    dist_to_t = scipy.ndimage.distance_transform_edt(~t_surface, sampling=_spacing)
+    dist_to_p = scipy.ndimage.distance_transform_edt(~p_surface, sampling=_spacing)
+    p_surface_labels = np.where(p_surface, p_labels, 0)
+    t_surface_labels = np.where(t_surface, t_labels, 0)
+    pred_boxes = scipy.ndimage.find_objects(p_labels, max_label=overlap.n_pred)
+    truth_boxes = scipy.ndimage.find_objects(t_labels, max_label=overlap.n_truth)
+    matches = overlap.intersection.tocsc()
+    for j, truth_box in enumerate(truth_boxes):
+        matched = matches.indices[matches.indptr[j] : matches.indptr[j + 1]]
+        if truth_box is None or matched.size == 0:
+            continue
+        box = _union_box([truth_box] + [pred_boxes[i] for i in matched])
+        in_truth = t_surface_labels[box] == j + 1
+        in_pred = np.isin(p_surface_labels[box], matched + 1)
+        distances[j] = SurfaceDistances(
+            dist_to_t[box][in_pred], dist_to_p[box][in_truth]
+        )
+    return distances
+
+
+def _union_box(
+    boxes: typing.Sequence[typing.Tuple[builtins.slice, ...]]
+) -> typing.Tuple[builtins.slice, ...]:
+    return tuple(
+        builtins.slice(min(s.start for s in ss), max(s.stop for s in ss))
+        for ss in zip(*boxes)
+    )
+
+
+def surface_points(surface_mask: np.ndarray, spacing: Spacing) -> np.ndarray:
+    """physical coordinates of the voxels in a surface image"""
+    points: np.ndarray = np.argwhere(surface_mask) * np.asarray(spacing)
+    return points
+
+
+def surface_point_sets(
+    pred: lmt.Label,
+    truth: lmt.Label,
+    *,
+    spacing: typing.Optional[typing.Sequence[builtins.float]] = None,
+    margin: builtins.int = 1,
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """physical coordinates of the surface voxels of both masks (relative
+    to the union bounding box); empty if either surface is empty"""
+    surfaces = _cropped_surfaces(pred, truth, spacing, margin)
+    if surfaces is None:
+        empty = np.zeros((0, pred.ndim))
+        return empty, empty.copy()
+    p_surface, t_surface, _spacing = surfaces
+    return surface_points(p_surface, _spacing), surface_points(t_surface, _spacing)
+
+
+def directed_hausdorff(
+    points: np.ndarray,
+    other: typing.Union[np.ndarray, scipy.spatial.cKDTree],
+    *,
+    lower_bound: builtins.float = 0.0,
+    chunk_size: builtins.int = 4096,
+    seed: builtins.int = 0,
+) -> builtins.float:
+    """exact directed hausdorff distance from `points` to `other`
+
+    points are visited in random order and each chunk is first queried
+    with the running maximum as an upper bound on the search radius; only
+    the points whose nearest neighbor lies farther than the running maximum
+    (which quickly becomes rare) need an unbounded nearest-neighbor search.
+    a known `lower_bound` on the result (e.g., the other direction's
+    distance in a symmetric hausdorff distance) prunes the search further.
+    """
+    tree = (
+        other
+        if isinstance(other, scipy.spatial.cKDTree)
+        else scipy.spatial.cKDTree(other)
+    )
+    order = np.random.default_rng(seed).permutation(len(points))
+    cmax = lower_bound
+    for start in range(0, len(order), chunk_size):
+        chunk = points[order[start : start + chunk_size]]
+        if cmax > 0.0:
+            dist, _ = tree.query(chunk, distance_upper_bound=cmax, workers=-1)
+            chunk = chunk[~np.isfinite(dist)]
+            if chunk.size == 0:
+                continue
+        dist, _ = tree.query(chunk, workers=-1)
+        cmax = max(cmax, float(dist.max()))
+    return cmax
+
+
+def hausdorff_from_points(
+    pred_points: np.ndarray,
+    truth_points: np.ndarray,
+    *,
+    percentiles: typing.Sequence[builtins.float] = (),
+    seed: builtins.int = 0,
+) -> typing.Tuple[builtins.float, typing.List[builtins.float]]:
+    """exact (symmetric) hausdorff distance between two surface point sets
+    and, optionally, percentile hausdorff distances
+
+    without percentiles, the early-break search in `directed_hausdorff`
+    avoids most of the nearest-neighbor work; percentiles require the
+    distance of every point, so all points are queried in that case
+    """
+    if len(pred_points) == 0 or len(truth_points) == 0:
+        return lmt.NaN, [lmt.NaN for _ in percentiles]
+    pred_tree = scipy.spatial.cKDTree(pred_points)
+    truth_tree = scipy.spatial.cKDTree(truth_points)
+    if not percentiles:
+        hd = directed_hausdorff(pred_points, truth_tree, seed=seed)
+        hd = directed_hausdorff(truth_points, pred_tree, lower_bound=hd, seed=seed)
+        return hd, []
+    dist_to_t, _ = truth_tree.query(pred_points, workers=-1)
+    dist_to_p, _ = pred_tree.query(truth_points, workers=-1)
+    distances = SurfaceDistances(dist_to_t, dist_to_p)
+    return distances.hausdorff(), [distances.hausdorff(q) for q in percentiles]
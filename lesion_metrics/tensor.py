@@ -0,0 +1,142 @@
+"""Torch-native voxel metrics
+
+confusion counts and voxel metrics which stay torch tensors on the
+device of the inputs, so a validation loop can accumulate results
+for many batches and synchronize once when the values are needed
+(e.g., with `TensorConfusionCounts.numpy`)
+"""
+
+from __future__ import annotations
+
+__all__ = [
+    "TensorConfusionCounts",
+    "batch_confusion_counts",
+    "confusion_counts",
+    "label",
+]
+
+import builtins
+import dataclasses
+import typing
+
+import numpy as np
+import skimage.measure
+
+import lesion_metrics.metrics as lmm
+
+if typing.TYPE_CHECKING:
+    import torch
+
+
+def _import_torch() -> typing.Any:
+    try:
+        import torch
+    except ImportError as imp_exn:
+        msg = "Require PyTorch to use the torch-native metrics"
+        raise RuntimeError(msg) from imp_exn
+    return torch
+
+
+@dataclasses.dataclass(frozen=True)
+class TensorConfusionCounts:
+    """confusion counts as (integer) tensors, 0-d or one entry per item"""
+
+    tp: torch.Tensor
+    fp: torch.Tensor
+    fn: torch.Tensor
+    tn: torch.Tensor
+
+    @classmethod
+    def cat(
+        cls, counts: typing.Sequence[TensorConfusionCounts]
+    ) -> TensorConfusionCounts:
+        """concatenate the counts of several (batches of) items"""
+        th = _import_torch()
+        fields = {}
+        for field in ("tp", "fp", "fn", "tn"):
+            values = [getattr(c, field).reshape(-1) for c in counts]
+            fields[field] = th.cat(values)
+        return cls(**fields)
+
+    @property
+    def pred_count(self) -> torch.Tensor:
+        return self.tp + self.fp
+
+    @property
+    def truth_count(self) -> torch.Tensor:
+        return self.tp + self.fn
+
+    def dice(self) -> torch.Tensor:
+        return _ratios(2 * self.tp, self.pred_count + self.truth_count)
+
+    def jaccard(self) -> torch.Tensor:
+        return _ratios(self.tp, self.tp + self.fp + self.fn)
+
+    def ppv(self) -> torch.Tensor:
+        return _ratios(self.tp, self.pred_count)
+
+    def tpr(self) -> torch.Tensor:
+        return _ratios(self.tp, self.truth_count)
+
+    def avd(self) -> torch.Tensor:
+        return _ratios((self.pred_count - self.truth_count).abs(), self.truth_count)
+
+    def numpy(self) -> lmm.StackedConfusionCounts:
+        """copy the counts to the host (synchronizes with the device)"""
+        th = _import_torch()
+        stacked = th.stack([self.tp, self.fp, self.fn, self.tn])
+        tp, fp, fn, tn = stacked.reshape(4, -1).cpu().numpy()
+        return lmm.StackedConfusionCounts(tp=tp, fp=fp, fn=fn, tn=tn)
+
+
+def _ratios(numer: torch.Tensor, denom: torch.Tensor) -> torch.Tensor:
+    th = _import_torch()
+    ratio = numer / denom.clamp(min=1)
+    nan = th.full_like(ratio, float("nan"))
+    out: torch.Tensor = th.where(denom == 0, nan, ratio)
+    return out
+
+
+def _counts(
+    pred: torch.Tensor,
+    truth: torch.Tensor,
+    dim: typing.Optional[typing.Tuple[builtins.int, ...]],
+) -> TensorConfusionCounts:
+    assert pred.shape == truth.shape
+    p, t = (pred > 0.0), (truth > 0.0)
+    tp = (p & t).count_nonzero(dim=dim)
+    n_pred = p.count_nonzero(dim=dim)
+    n_truth = t.count_nonzero(dim=dim)
+    n_voxels = p.numel() if dim is None else p[0].numel()
+    fp = n_pred - tp
+    fn = n_truth - tp
+    tn = n_voxels - tp - fp - fn
+    return TensorConfusionCounts(tp=tp, fp=fp, fn=fn, tn=tn)
+
+
+def confusion_counts(pred: torch.Tensor, truth: torch.Tensor) -> TensorConfusionCounts:
+    """0-d tensor confusion counts between predicted and true binary masks"""
+    return _counts(pred, truth, None)
+
+
+def batch_confusion_counts(
+    pred: torch.Tensor, truth: torch.Tensor
+) -> TensorConfusionCounts:
+    """tensor confusion counts per item of a batch of masks with shape (B, ...)"""
+    assert pred.ndim >= 2, "Batched masks require a leading batch axis."
+    return _counts(pred, truth, tuple(range(1, pred.ndim)))
+
+
+def label(
+    mask: torch.Tensor, *, connectivity: typing.Optional[builtins.int] = None
+) -> typing.Tuple[np.ndarray, builtins.int]:
+    """connected components of a (cpu) mask tensor
+
+    the components are computed directly on the tensor's memory (a
+    boolean tensor is viewed, not copied); only masks on an accelerator
+    are copied to the host
+    """
+    m = mask if mask.dtype == _import_torch().bool else mask > 0.0
+    array = m.detach().cpu().numpy()
+    labels, n = skimage.measure.label(array, return_num=True, connectivity=connectivity)
+    return labels, int(n)
@@ -49,6 +49,10 @@ class Label(typing.Protocol):
     def ndim(self) -> builtins.int:
         ...
 
+    @property
+    def shape(self) -> typing.Tuple[builtins.int, ...]:
+        ...
+
     def any(
         self,
         axis: typing.Optional[
@@ -4,7 +4,14 @@ Created on: 16 Aug 2021
 """
 
 __all__ = [
+    "as_label_map",
     "bbox",
+    "binarize",
+    "count_nonzero",
+    "count_nonzero_in_bboxes",
+    "count_nonzeros",
+    "count_not_above",
+    "numel",
     "to_numpy",
 ]
 
@@ -12,9 +19,22 @@ import builtins
 import itertools
 import typing
 
+import numpy as np
+
 import lesion_metrics.typing as lmt
 
 
+def as_label_map(label: lmt.Label) -> np.ndarray:
+    """integer (intp) numpy array of a multi-class label image"""
+    array = np.asarray(to_numpy(label))
+    if not np.issubdtype(array.dtype, np.integer):
+        array = np.rint(array)
+    if array.size and array.min() < 0:
+        raise ValueError("Label maps must not contain negative labels.")
+    label_map: np.ndarray = array.astype(np.intp, copy=False)
+    return label_map
+
+
 def bbox(label: lmt.Label) -> typing.List[builtins.slice]:
     ndim = label.ndim
     assert isinstance(ndim, int)
@@ -28,7 +48,65 @@ def bbox(label: lmt.Label) -> typing.List[builtins.slice]:
     return indices
 
 
+def binarize(label: lmt.Label) -> lmt.Label:
+    """`label > 0`, skipping the comparison for masks that are already boolean"""
+    if str(getattr(label, "dtype", "")) in ("bool", "torch.bool"):
+        return label
+    mask: lmt.Label = label > 0.0
+    return mask
+
+
+def count_nonzero(label: lmt.Label) -> builtins.int:
+    """number of nonzero elements without summing a boolean array"""
+    if hasattr(label, "count_nonzero"):  # torch tensors
+        return int(label.count_nonzero())
+    return int(np.count_nonzero(label))  # type: ignore[call-overload]
+
+
+def count_nonzeros(*labels: lmt.Label) -> typing.List[builtins.int]:
+    """number of nonzero elements of each label image
+
+    for torch tensors the counts are gathered so that the host
+    synchronizes with the device once instead of once per count
+    """
+    if labels and hasattr(labels[0], "count_nonzero"):  # torch tensors
+        import torch
+
+        counts = [label.count_nonzero() for label in labels]  # type: ignore
+        return [int(c) for c in torch.stack(counts).tolist()]
+    return [count_nonzero(label) for label in labels]
+
+
+def count_nonzero_in_bboxes(
+    label: lmt.Label,
+    bboxes: typing.Sequence[typing.Optional[typing.Tuple[builtins.slice, ...]]],
+) -> np.ndarray:
+    """number of nonzero elements inside each bounding box (e.g., from
+    `scipy.ndimage.find_objects`); missing boxes have a count of zero"""
+    counts = np.zeros(len(bboxes), dtype=np.int64)
+    for i, box in enumerate(bboxes):
+        if box is not None:
+            counts[i] = np.count_nonzero(label[box])
+    return counts
+
+
+def count_not_above(
+    values: np.ndarray, thresholds: typing.Sequence[builtins.float]
+) -> np.ndarray:
+    """number of values <= each threshold (one sort for all thresholds)"""
+    sorted_values = np.sort(np.asarray(values).ravel())
+    counts: np.ndarray = np.searchsorted(sorted_values, thresholds, side="right")
+    return counts
+
+
+def numel(label: lmt.Label) -> builtins.int:
+    """total number of elements in a label image"""
+    if hasattr(label, "numel"):  # torch tensors
+        return int(label.numel())
+    return int(np.size(label))  # type: ignore[arg-type]
+
+
 def to_numpy(label: lmt.Label) -> lmt.Label:
-    if hasattr(label, "numpy"):
-        label = label.numpy()  # type: ignore[attr-defined]
+    if hasattr(label, "numpy"):  # torch tensors; no copy for cpu tensors
+        label = label.detach().cpu().numpy()  # type: ignore[attr-defined]
     return label
@@ -9,11 +9,30 @@ Created on: 16 Aug 2021
 
 from __future__ import annotations
 
+__all__ = [
+    "CHUNK_VOXELS",
+    "LesionVolumes",
+    "SegmentationVolume",
+    "UnitOfVolume",
+    "count_positive_voxels",
+    "streaming_volume",
+    "streaming_volumes",
+]
+
+import builtins
+import concurrent.futures
+import dataclasses
 import enum
 import functools
 import operator
+import os
+import typing
+
+import numpy as np
+import skimage.measure
 
 import lesion_metrics.typing as lmt
+from lesion_metrics.utils import binarize, to_numpy
 
 
 class UnitOfVolume(enum.Enum):
@@ -25,6 +44,35 @@ class UnitOfVolume(enum.Enum):
     litre = "litre"
 
 
+@dataclasses.dataclass(frozen=True)
+class LesionVolumes:
+    """volume of each lesion (connected component) of a segmentation
+
+    `volumes[i]` is the volume of the lesion labeled i + 1 in `unit`
+    """
+
+    volumes: np.ndarray
+    unit: UnitOfVolume
+
+    @property
+    def count(self) -> builtins.int:
+        """number of lesions"""
+        return int(self.volumes.size)
+
+    @property
+    def total(self) -> builtins.float:
+        """total lesion burden"""
+        return float(self.volumes.sum())
+
+    def histogram(
+        self, bins: typing.Union[builtins.int, typing.Sequence[builtins.float]] = 10
+    ) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """number of lesions in each volume bin and the bin edges (in `unit`);
+        see `numpy.histogram` for the meaning of `bins`"""
+        counts, edges = np.histogram(self.volumes, bins=bins)
+        return counts, edges
+
+
 class SegmentationVolume:
     def __init__(
         self,
@@ -46,15 +94,27 @@ class SegmentationVolume:
         return cls(label)
 
     def volume(self) -> float:
-        vol_in_micro = self.volume_in_microliters()
-        if self.unit == UnitOfVolume.microliter:
-            return vol_in_micro
-        elif self.unit == UnitOfVolume.milliliter:
-            return vol_in_micro / 1e3
-        elif self.unit == UnitOfVolume.liter:
-            return vol_in_micro / 1e6
-        else:
-            raise ValueError(f"Invalid unit: {self.unit}")
+        return _from_microliters(self.volume_in_microliters(), self.unit)
+
+    def lesion_volumes(
+        self,
+        *,
+        labels: typing.Optional[np.ndarray] = None,
+        connectivity: typing.Optional[builtins.int] = None,
+    ) -> LesionVolumes:
+        """volume of each lesion in `unit` from one labeling and one bincount
+
+        precomputed connected-component `labels` of the segmentation
+        (0 is background) are used as is instead of labeling again
+        """
+        if labels is None:
+            mask = to_numpy(binarize(self.label))
+            labels = skimage.measure.label(mask, connectivity=connectivity)
+        assert labels is not None
+        per_voxel_volume = functools.reduce(operator.mul, self.label.spacing, 1.0)
+        sizes = np.bincount(labels.ravel())[1:]
+        volumes = sizes * per_voxel_volume / _microliters_per(self.unit)
+        return LesionVolumes(volumes=volumes, unit=self.unit)
 
     def volume_in_microlitres(self) -> float:
         return self.volume_in_microliters()
@@ -65,3 +125,117 @@ class SegmentationVolume:
         n_positive_voxels = (self.label > 0.0).sum()
         volume_in_microliters: float = n_positive_voxels * per_voxel_volume
         return volume_in_microliters
+
+
+def _microliters_per(unit: UnitOfVolume) -> builtins.float:
+    if unit == UnitOfVolume.microliter:
+        return 1.0
+    elif unit == UnitOfVolume.milliliter:
+        return 1e3
+    elif unit == UnitOfVolume.liter:
+        return 1e6
+    else:
+        raise ValueError(f"Invalid unit: {unit}")
+
+
+def _from_microliters(vol_in_micro: builtins.float, unit: UnitOfVolume) -> float:
+    return vol_in_micro / _microliters_per(unit)
+
+
+def _import_nibabel() -> typing.Any:
+    try:
+        import nibabel
+    except ImportError as imp_exn:
+        msg = "Require nibabel to use the streaming volume methods"
+        raise RuntimeError(msg) from imp_exn
+    return nibabel
+
+
+def _is_nifti(path: lmt.PathLike) -> builtins.bool:
+    return os.fspath(path).endswith((".nii", ".nii.gz"))
+
+
+# voxels per slab in the streaming volume (4 MiB of float32 values);
+# a 256^3 image is read in 16 slabs
+CHUNK_VOXELS = 2**20
+
+
+def _slabs(
+    shape: typing.Tuple[builtins.int, ...], chunk_voxels: builtins.int
+) -> typing.List[builtins.slice]:
+    """slices of at most `chunk_voxels` voxels (but at least one index)
+    along the last axis of an image of the given shape"""
+    if chunk_voxels < 1:
+        raise ValueError(f"chunk_voxels must be positive. Got {chunk_voxels}.")
+    slab_size = int(np.prod(shape[:-1], dtype=np.int64))
+    step = max(chunk_voxels // max(slab_size, 1), 1)
+    return [slice(start, start + step) for start in range(0, shape[-1], step)]
+
+
+def count_positive_voxels(
+    path: lmt.PathLike, *, chunk_voxels: builtins.int = CHUNK_VOXELS
+) -> typing.Tuple[builtins.int, typing.Tuple[builtins.float, ...]]:
+    """number of positive voxels and the (spatial) voxel spacing of a NIfTI
+    image without loading the image into memory
+
+    the spacing comes from the header and the voxels are counted in slabs
+    of about `chunk_voxels` voxels along the last (slowest) axis: through
+    a memory map for `.nii` files and by streaming the decompression for
+    `.nii.gz` files, so neither the full image nor a full mask is ever held
+    """
+    nib = _import_nibabel()
+    compressed = not os.fspath(path).endswith(".nii")
+    image = nib.load(os.fspath(path), mmap=not compressed, keep_file_open=True)
+    shape = image.shape
+    spacing = tuple(float(z) for z in image.header.get_zooms()[: min(len(shape), 3)])
+    proxy = image.dataobj
+    # a memory map of the raw values; otherwise each slab is decompressed
+    # (and scaled) on its own, in file order, from the kept-open stream
+    raw = proxy.get_unscaled() if not compressed else None
+    slope, inter = float(proxy.slope), float(proxy.inter)
+    count = 0
+    for index in _slabs(shape, chunk_voxels):
+        if raw is None:
+            slab = proxy[..., index]
+        elif slope == 1.0 and inter == 0.0:
+            slab = raw[..., index]
+        else:
+            slab = raw[..., index] * slope + inter
+        count += int(np.count_nonzero(slab > 0.0))
+    return count, spacing
+
+
+def streaming_volume(
+    path: lmt.PathLike,
+    unit: UnitOfVolume = UnitOfVolume.microliter,
+    *,
+    chunk_voxels: builtins.int = CHUNK_VOXELS,
+) -> float:
+    """segmentation volume of an image file (see `count_positive_voxels`);
+    files other than NIfTI are loaded with `SegmentationVolume.from_filename`"""
+    if not _is_nifti(path):
+        segmentation_volume = SegmentationVolume.from_filename(path)
+        segmentation_volume.unit = unit
+        return segmentation_volume.volume()
+    count, spacing = count_positive_voxels(path, chunk_voxels=chunk_voxels)
+    per_voxel_volume = functools.reduce(operator.mul, spacing, 1.0)
+    return _from_microliters(count * per_voxel_volume, unit)
+
+
+def streaming_volumes(
+    paths: typing.Sequence[lmt.PathLike],
+    unit: UnitOfVolume = UnitOfVolume.microliter,
+    *,
+    chunk_voxels: builtins.int = CHUNK_VOXELS,
+    max_workers: typing.Optional[builtins.int] = None,
+) -> typing.List[float]:
+    """segmentation volume of each image file (in order) with `streaming_volume`
+    in a pool of `max_workers` processes (one per cpu if None; 1 runs serially)
+    """
+    volume = functools.partial(streaming_volume, unit=unit, chunk_voxels=chunk_voxels)
+    if max_workers == 1 or len(paths) <= 1:
+        return [volume(path) for path in paths]
+    n_workers = max_workers or os.cpu_count() or 1
+    chunksize = max(len(paths) // (4 * n_workers), 1)
+    with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+        return list(executor.map(volume, paths, chunksize=chunksize))
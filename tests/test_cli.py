@@ -1,15 +1,23 @@
 #!/usr/bin/env python
 """Tests for `lesion_metrics` package."""
 
+import argparse
 import builtins
+import concurrent.futures
+import json
 import os
 import pathlib
 import shutil
 import typing
 
+import numpy as np
 import pytest
 
 import lesion_metrics.cli.aggregate as lmca
+import lesion_metrics.cli.cache as lmcca
+import lesion_metrics.cli.common as lmcc
+import lesion_metrics.cli.per_lesion as lmcp
+import lesion_metrics.cli.volume as lmcv
 
 
 @pytest.fixture
@@ -33,7 +41,7 @@ def _copy_test_data(
 ) -> pathlib.Path:
     fn = cwd / "test_data" / name / f"{name}.nii.gz"
     tmp = temp_dir / name
-    os.mkdir(tmp)
+    os.makedirs(tmp, exist_ok=True)
     shutil.copyfile(fn, tmp / f"{name}1.nii.gz")
     shutil.copyfile(fn, tmp / f"{name}2.nii.gz")
     return tmp
@@ -64,3 +72,274 @@ def args(
 def test_cli(args: typing.List[builtins.str]) -> None:
     retval = lmca.main(args)
     assert retval == 0
+
+
+def test_cli_jsonl(
+    pred_dir: pathlib.Path, truth_dir: pathlib.Path, temp_dir: pathlib.Path
+) -> None:
+    out_file = temp_dir / "out.jsonl"
+    args = f"-p {pred_dir} -t {truth_dir} -o {out_file} -c -m dice"
+    retval = lmca.main(args.split())
+    assert retval == 0
+    rows = [json.loads(line) for line in out_file.read_text().splitlines()]
+    assert len(rows) == 2 + 7  # pairs, summary statistics
+    assert rows[0]["Dice"] == rows[1]["Dice"] == rows[2]["Dice"]  # avg
+    assert "Vol. Correlation" in rows[0]
+    assert rows[1]["Vol. Correlation"] is None
+
+
+def test_cli_iou_threshold_sweep(
+    pred_dir: pathlib.Path, truth_dir: pathlib.Path, temp_dir: pathlib.Path
+) -> None:
+    out_file = temp_dir / "sweep.csv"
+    args = f"-p {pred_dir} -t {truth_dir} -o {out_file} -it 0.0 -itr 0 0.5 3"
+    retval = lmca.main(args.split())
+    assert retval == 0
+    header = out_file.read_text().splitlines()[0].split(",")
+    for thresh in ("0", "0.25", "0.5"):
+        assert f"LFDR@{thresh}" in header
+        assert f"LTPR@{thresh}" in header
+
+
+def test_cli_metrics(
+    pred_dir: pathlib.Path, truth_dir: pathlib.Path, temp_dir: pathlib.Path
+) -> None:
+    out_file = temp_dir / "dice.csv"
+    args = f"-p {pred_dir} -t {truth_dir} -o {out_file} -m dice hd95"
+    retval = lmca.main(args.split())
+    assert retval == 0
+    assert out_file.read_text().splitlines()[0] == "Pred,Truth,Dice,HD95"
+
+
+def test_cli_jobs(
+    pred_dir: pathlib.Path, truth_dir: pathlib.Path, temp_dir: pathlib.Path
+) -> None:
+    outputs = []
+    for jobs in (1, 2):
+        out_file = temp_dir / f"jobs{jobs}.csv"
+        args = f"-p {pred_dir} -t {truth_dir} -o {out_file} -c -j {jobs}"
+        retval = lmca.main(args.split())
+        assert retval == 0
+        outputs.append(out_file.read_text())
+    assert outputs[0] == outputs[1]
+
+
+def test_cli_cache(
+    pred_dir: pathlib.Path, truth_dir: pathlib.Path, temp_dir: pathlib.Path
+) -> None:
+    cache = temp_dir / "cache.db"
+    outputs = []
+    for _ in range(2):
+        out_file = temp_dir / "cached.csv"
+        args = f"-p {pred_dir} -t {truth_dir} -o {out_file} --cache {cache}"
+        retval = lmca.main(args.split())
+        assert retval == 0
+        outputs.append(out_file.read_text())
+    assert outputs[0] == outputs[1]
+    with lmcca.ResultCache(cache) as result_cache:
+        pred_fn = sorted(pred_dir.glob("*"))[0]
+        truth_fn = sorted(truth_dir.glob("*"))[0]
+        key = result_cache.key(pred_fn, truth_fn, {"metrics": ["dice"]})
+        assert result_cache.get(key) is None
+        result_cache.put(key, {"dice": 0.5})
+        assert result_cache.get(key) == {"dice": 0.5}
+
+
+def test_cli_stem_pairing(
+    pred_dir: pathlib.Path, truth_dir: pathlib.Path, temp_dir: pathlib.Path
+) -> None:
+    out_file = temp_dir / "stem.csv"
+    args = (
+        f"-p {pred_dir} -t {truth_dir} -o {out_file} -m dice --pairing stem "
+        "--pred-prefix pred --truth-prefix truth"
+    )
+    retval = lmca.main(args.split())
+    assert retval == 0
+    rows = [line.split(",")[:2] for line in out_file.read_text().splitlines()]
+    assert rows[1:3] == [["pred1", "truth1"], ["pred2", "truth2"]]
+
+
+def test_pair_by_stem(temp_dir: pathlib.Path) -> None:
+    root = temp_dir / "bids"
+    for name in ("sub-01/anat/sub-01_lesion.nii.gz", "sub-02/sub-02_lesion.nii"):
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).touch()
+    (root / "sub-01" / "notes.txt").touch()
+    (root / "._sub-01_lesion.nii.gz").touch()
+    # same files as the previous `sorted(path.glob("*.nii*"))`, hidden ones too
+    assert lmcc.glob_imgs(root) == sorted(root.glob("*.nii*"))
+    assert lmcc.glob_imgs(root) == [root / "._sub-01_lesion.nii.gz"]
+    (root / "._sub-01_lesion.nii.gz").unlink()
+    assert lmcc.glob_imgs(root) == []
+    assert len(lmcc.glob_imgs(root, recursive=True)) == 2
+    rule = lmcc.StemRule(suffix="_lesion")
+    truth_index = lmcc.index_imgs(root, rule, recursive=True)
+    assert sorted(truth_index) == ["sub-01", "sub-02"]
+    pred_index = {"sub-02": root / "pred.nii", "sub-03": root / "other.nii"}
+    pairs, pred_only, truth_only = lmcc.pair_by_stem(pred_index, truth_index)
+    assert pairs == [(pred_index["sub-02"], truth_index["sub-02"])]
+    assert pred_only == [pred_index["sub-03"]]
+    assert truth_only == [truth_index["sub-01"]]
+    assert lmcc.StemRule(pattern=r"sub-(\d+)")(root / "x_sub-07_t1.nii.gz") == "07"
+    assert lmcc.StemRule(pattern="ses")(root / "sub-07.nii") is None
+
+
+def test_cli_bootstrap(
+    pred_dir: pathlib.Path, truth_dir: pathlib.Path, temp_dir: pathlib.Path
+) -> None:
+    out_file = temp_dir / "bootstrap.csv"
+    args = f"-p {pred_dir} -t {truth_dir} -o {out_file} -c -b 100"
+    retval = lmca.main(args.split() + ["--subject-pattern", r"(\w+)\d"])
+    assert retval == 0
+    labels = [line.split(",")[1] for line in out_file.read_text().splitlines()]
+    assert labels[-2:] == ["95% CI Low", "95% CI High"]
+    # a NaN pair makes the interval NaN, consistent with the Avg row
+    values = {column: [0.5, 0.6, 0.7, 0.8] for column in lmca.COLUMNS.values()}
+    values[lmca.COLUMNS["dice"]][1] = float("nan")
+    bootstrap_args = argparse.Namespace(
+        confidence=0.9, bootstrap=100, output_correlation=True
+    )
+    lower, upper = lmca._confidence_interval_rows(bootstrap_args, values, None)
+    assert lower["Truth"] == "90% CI Low"
+    assert np.isnan([lower["Dice"], upper["Dice"]]).all()
+    assert np.isnan(lmcc.summary_statistics(values[lmca.COLUMNS["dice"]])["Avg"])
+    assert lower["Jaccard"] <= 0.65 <= upper["Jaccard"]
+
+
+def test_cli_shard_merge(
+    pred_dir: pathlib.Path, truth_dir: pathlib.Path, temp_dir: pathlib.Path
+) -> None:
+    out_file = temp_dir / "unsharded.csv"
+    base = f"-p {pred_dir} -t {truth_dir} -c"
+    assert lmca.main(f"{base} -o {out_file}".split()) == 0
+    # independent processes stand in for the jobs on a cluster
+    partials = [temp_dir / f"shard{i}.csv" for i in range(3)]
+    shard_args = [
+        f"{base} -o {p} --shard {i}/3".split() for i, p in enumerate(partials)
+    ]
+    with concurrent.futures.ProcessPoolExecutor(3) as executor:
+        assert list(executor.map(lmca.main, shard_args)) == [0, 0, 0]
+    merged_file = temp_dir / "merged.csv"
+    merge_args = ["merge", *map(str, partials[::-1]), "-o", str(merged_file)]
+    assert lmca.main(merge_args) == 0
+    expected = out_file.read_text().splitlines()
+    merged = merged_file.read_text().splitlines()
+    assert merged[:3] == expected[:3]
+    for line, expected_line in zip(merged[3:], expected[3:]):
+        label, *values = line.split(",")[1:]
+        expected_label, *expected_values = expected_line.split(",")[1:]
+        assert label == expected_label
+        assert np.allclose(
+            [float(v or "nan") for v in values],
+            [float(v or "nan") for v in expected_values],
+            equal_nan=True,
+        )
+    with pytest.raises(ValueError):
+        lmca.main(["merge", str(partials[0]), "-o", str(merged_file)])
+    # a shard evaluated with another (first) iou threshold does not merge
+    other = temp_dir / "shard1_other.csv"
+    assert lmca.main(f"{base} -o {other} --shard 1/3 -it 0.5".split()) == 0
+    with pytest.raises(ValueError):
+        merge_args = [str(partials[0]), str(other), str(partials[2])]
+        lmca.main(["merge", *merge_args, "-o", str(merged_file)])
+
+
+def test_accumulators() -> None:
+    xs, ys = [1.0, 2.0, 4.0, 3.5], [0.5, 2.0, 3.0, 4.5]
+    summary = lmcc.SummaryAccumulator()
+    correlation = lmcc.CorrelationAccumulator()
+    for x, y in zip(xs, ys):
+        summary.update(x)
+        correlation.add(x, y)
+    assert summary.statistics() == pytest.approx(lmcc.summary_statistics(xs))
+    halves = lmcc.SummaryAccumulator(), lmcc.SummaryAccumulator()
+    for i, x in enumerate(xs):
+        halves[i % 2].update(x)
+    merged = halves[0].merge(halves[1]).statistics()
+    assert merged == pytest.approx(summary.statistics())
+    for values in ([1.0, float("nan"), 3.0], [float("nan")] * 2):
+        with_nan = lmcc.SummaryAccumulator()
+        for value in values:
+            with_nan.update(value)
+        assert np.isnan(list(with_nan.statistics().values())).all()
+        assert np.isnan(list(lmcc.summary_statistics(values).values())).all()
+    halves[0].merge(with_nan)
+    assert np.isnan(halves[0].statistics()["Min"])
+    assert correlation.correlation() == pytest.approx(np.corrcoef(xs, ys)[0, 1])
+    state = json.loads(json.dumps(summary.to_dict()))
+    assert lmcc.SummaryAccumulator.from_dict(state).statistics() == summary.statistics()
+    parts = lmcc.CorrelationAccumulator(), lmcc.CorrelationAccumulator()
+    for i, (x, y) in enumerate(zip(xs, ys)):
+        parts[i % 2].add(x, y)
+    part = lmcc.CorrelationAccumulator.from_dict(parts[1].to_dict())
+    merged_correlation = parts[0].merge(part).correlation()
+    assert merged_correlation == pytest.approx(correlation.correlation())
+
+
+def test_quantile_sketch() -> None:
+    values = np.random.default_rng(0).normal(size=20_000)
+    summaries = [lmcc.SummaryAccumulator(sketch_size=100) for _ in range(4)]
+    for i, value in enumerate(values.tolist()):
+        summaries[i % 4].update(value)
+    for other in summaries[1:]:
+        summaries[0].merge(other)
+    assert summaries[0].sketch is not None
+    assert sum(map(len, summaries[0].sketch.compactors)) < 1_000
+    statistics = summaries[0].statistics()
+    sorted_values = np.sort(values)
+    for q in (25, 50, 75):
+        rank = np.searchsorted(sorted_values, statistics[f"{q}%"]) / values.size
+        assert abs(rank - q / 100) < 0.02
+    assert statistics["Max"] == values.max()
+    # NaNs never reach the sketch; like the exact summary, all become NaN
+    with_nan = lmcc.SummaryAccumulator(sketch_size=8)
+    for value in [float("nan"), 0.1, 0.9, 0.5] * 10:
+        with_nan.update(value)
+    assert np.isnan(list(with_nan.statistics().values())).all()
+    with pytest.raises(ValueError):
+        lmcc.QuantileSketch(8).update(float("nan"))
+    with pytest.raises(ValueError):
+        lmcc.QuantileSketch(8).merge(lmcc.QuantileSketch(16))
+
+
+def test_prefetch() -> None:
+    def load(i: builtins.int) -> np.ndarray:
+        return np.full(10, i)
+
+    for depth, max_bytes in ((0, None), (3, None), (3, 1)):
+        loaded = lmcc.prefetch(load, range(5), depth=depth, max_bytes=max_bytes)
+        assert [int(x[0]) for x in loaded] == list(range(5))
+
+
+def test_cli_surface_dice(
+    pred_dir: pathlib.Path, truth_dir: pathlib.Path, temp_dir: pathlib.Path
+) -> None:
+    out_file = temp_dir / "surface_dice.csv"
+    args = f"-p {pred_dir} -t {truth_dir} -o {out_file} -sdt 0.5 1 2"
+    retval = lmca.main(args.split())
+    assert retval == 0
+    header = out_file.read_text().splitlines()[0].split(",")
+    for tol in ("0.5", "1", "2"):
+        assert f"Surface Dice@{tol}" in header
+
+
+def test_per_lesion_cli(cwd: pathlib.Path, temp_dir: pathlib.Path) -> None:
+    pred = cwd / "test_data" / "pred" / "pred.nii.gz"
+    truth = cwd / "test_data" / "truth" / "truth.nii.gz"
+    out_file = temp_dir / "per_lesion.csv"
+    retval = lmcp.main(f"-p {pred} -t {truth} -o {out_file}".split())
+    assert retval == 0
+    lines = out_file.read_text().splitlines()
+    assert lines[0].startswith("Pred,Truth,Center,Dice")
+    assert ",AVD,ASSD,HD95,Lesion Vol.," in lines[0]
+    assert len(lines) == 1 + 3 + 7  # header, lesions, summary statistics
+
+
+def test_volume_cli(pred_dir: pathlib.Path, temp_dir: pathlib.Path) -> None:
+    out_file = temp_dir / "volume.csv"
+    retval = lmcv.main(f"{pred_dir} -o {out_file} -j 2 -cv 25".split())
+    assert retval == 0
+    lines = out_file.read_text().splitlines()
+    assert lines[0] == "Image,Path,Volume (microliter)"
+    assert len(lines) == 1 + 2 + 7  # header, images, summary statistics
+    assert lines[1].endswith(",4.0")
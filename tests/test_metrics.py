@@ -2,12 +2,19 @@
 """Tests for `lesion_metrics` package."""
 
 import builtins
+import dataclasses
 import pathlib
+import typing
 
 import medio.image as mioi
+import numpy as np
 import pytest
 
+import lesion_metrics.bootstrap as lmb
+import lesion_metrics.context as lmc
 import lesion_metrics.metrics as lmm
+import lesion_metrics.overlap as lmo
+import lesion_metrics.surface as lms
 import lesion_metrics.typing as lmt
 import lesion_metrics.volume as lmv
 
@@ -85,6 +92,98 @@ def test_tpr(pred: lmt.Label, truth: lmt.Label) -> None:
     assert tpr_score == correct
 
 
+def test_confusion_counts(pred: lmt.Label, truth: lmt.Label) -> None:
+    counts = lmm.confusion_counts(pred, truth)
+    assert (counts.tp, counts.fp, counts.fn, counts.tn) == (3, 1, 7, 114)
+    assert counts.pred_count == 4
+    assert counts.truth_count == 10
+
+
+def test_voxel_metrics(pred: lmt.Label, truth: lmt.Label) -> None:
+    vm = lmm.voxel_metrics(pred, truth)
+    assert vm.dice == lmm.dice(pred, truth)
+    assert vm.jaccard == lmm.jaccard(pred, truth)
+    assert vm.ppv == lmm.ppv(pred, truth)
+    assert vm.tpr == lmm.tpr(pred, truth)
+    assert vm.avd == lmm.avd(pred, truth)
+
+
+def test_batch_metrics(pred: lmt.Label, truth: lmt.Label) -> None:
+    empty = pred * 0
+    if isinstance(pred, np.ndarray):
+        preds, truths = np.stack([pred, empty]), np.stack([truth, empty])
+    else:
+        preds, truths = torch.stack([pred, empty]), torch.stack([truth, empty])
+    counts = lmm.batch_confusion_counts(preds, truths)
+    assert len(counts) == 2
+    assert counts[0] == lmm.confusion_counts(pred, truth)
+    assert counts[1].tn == sum(dataclasses.astuple(counts[0]))
+    dice_scores = lmm.batch_dice(preds, truths)
+    assert dice_scores[0] == lmm.dice(pred, truth)
+    assert np.isnan(dice_scores[1])
+    assert lmm.batch_jaccard(preds, truths)[0] == lmm.jaccard(pred, truth)
+    assert lmm.batch_ppv(preds, truths)[0] == lmm.ppv(pred, truth)
+    assert lmm.batch_tpr(preds, truths)[0] == lmm.tpr(pred, truth)
+    assert lmm.batch_avd(preds, truths)[0] == lmm.avd(pred, truth)
+
+
+def test_confusion_counts_at_thresholds(truth: lmt.Label) -> None:
+    truth = np.asarray(truth)
+    prob = np.linspace(0.0, 1.0, num=125).reshape(5, 5, 5)
+    thresholds = [0.75, 0.0, 0.5]
+    counts = lmm.confusion_counts_at_thresholds(prob, truth, thresholds)
+    for i, thresh in enumerate(thresholds):
+        assert counts[i] == lmm.confusion_counts(prob > thresh, truth)
+        assert counts.dice()[i] == lmm.dice(prob > thresh, truth)
+    binned = lmm.confusion_counts_at_thresholds(prob, truth, n_bins=4)
+    assert binned[2] == counts[2]
+
+
+def test_multiclass_metrics(pred: lmt.Label, truth: lmt.Label) -> None:
+    p, t = np.asarray(pred), np.asarray(truth)
+    pred_map = p + 2 * np.roll(p, 1, axis=0)
+    truth_map = t + 2 * np.roll(t, 1, axis=0)
+    matrix = lmm.multiclass_confusion_matrix(pred_map, truth_map)
+    assert matrix.shape == (4, 4)
+    assert matrix.sum() == p.size
+    with pytest.raises(ValueError):
+        # (pred=0, truth=3) would otherwise be counted as (pred=1, truth=0)
+        lmm.multiclass_confusion_matrix(np.array([0]), np.array([3]), n_classes=3)
+    counts = lmm.multiclass_confusion_counts(pred_map, truth_map)
+    for k in range(4):
+        assert counts[k] == lmm.confusion_counts(pred_map == k, truth_map == k)
+    overlaps = lmo.lesion_overlap_per_class(pred_map, truth_map)
+    assert sorted(overlaps) == [1, 2, 3]
+    assert overlaps[1].ltpr() == lmm.ltpr(pred_map == 1, truth_map == 1)
+
+
+def test_tensor_metrics(
+    backend: builtins.str, pred: lmt.Label, truth: lmt.Label
+) -> None:
+    if backend != "torch":
+        pytest.skip("Requires torch tensors.")
+    import lesion_metrics.tensor as lmten
+
+    counts = lmten.confusion_counts(pred, truth)
+    assert isinstance(counts.dice(), torch.Tensor)
+    assert counts.numpy()[0] == lmm.confusion_counts(pred, truth)
+    assert counts.dice().item() == pytest.approx(lmm.dice(pred, truth))
+    preds, truths = torch.stack([pred, pred * 0]), torch.stack([truth, truth * 0])
+    batch = lmten.batch_confusion_counts(preds, truths)
+    both = lmten.TensorConfusionCounts.cat([counts, batch])
+    assert len(both.numpy()) == 3
+    assert torch.isnan(both.dice()[2])
+    labels, n = lmten.label(pred)
+    assert n == 3
+    assert labels.shape == tuple(pred.shape)
+
+
+def test_iou_per_lesion(pred: lmt.Label, truth: lmt.Label) -> None:
+    ious, n_pred = lmm.iou_per_lesion(pred, truth, return_count=True)
+    assert n_pred == 3
+    assert ious.tolist() == [1.0, 0.0, 1.0]
+
+
 def test_lfdr(pred: lmt.Label, truth: lmt.Label) -> None:
     lfpr_score = lmm.lfdr(pred, truth)
     correct = 1 / 3
@@ -97,6 +196,101 @@ def test_ltpr(pred: lmt.Label, truth: lmt.Label) -> None:
     assert ltpr_score == correct
 
 
+def test_lesion_rate_curves(pred: lmt.Label, truth: lmt.Label) -> None:
+    thresholds = [0.0, 0.5, 1.0]
+    lfdrs = lmm.lfdr_curve(pred, truth, thresholds)
+    ltprs = lmm.ltpr_curve(pred, truth, thresholds)
+    for thresh, _lfdr, _ltpr in zip(thresholds, lfdrs, ltprs):
+        assert _lfdr == lmm.lfdr(pred, truth, iou_threshold=thresh)
+        assert _ltpr == lmm.ltpr(pred, truth, iou_threshold=thresh)
+    overlap = lmo.LesionOverlap.from_masks(pred, truth)
+    assert overlap.lfdr_curve(thresholds).tolist() == lfdrs.tolist()
+    assert overlap.ltpr_curve(thresholds).tolist() == ltprs.tolist()
+
+
+def test_lesion_rates_without_lesions(pred: lmt.Label) -> None:
+    empty = pred * 0
+    assert lmm.lfdr(empty, pred, return_pred_count=True)[1] == 0
+    ltpr_score, n_truth = lmm.ltpr(pred, empty, return_truth_count=True)
+    assert ltpr_score != ltpr_score  # NaN
+    assert n_truth == 0
+
+
+def test_lesion_overlap(pred: lmt.Label, truth: lmt.Label) -> None:
+    overlap = lmo.LesionOverlap.from_masks(pred, truth)
+    assert (overlap.n_pred, overlap.n_truth) == (3, 3)
+    assert overlap.intersection.toarray().tolist() == [
+        [2, 0, 0],
+        [0, 0, 0],
+        [0, 1, 0],
+    ]
+    assert overlap.pred_ious().tolist() == lmm.iou_per_lesion(pred, truth).tolist()
+    assert overlap.truth_ious().tolist() == lmm.iou_per_lesion(truth, pred).tolist()
+    assert overlap.lfdr() == lmm.lfdr(pred, truth)
+    assert overlap.ltpr() == lmm.ltpr(pred, truth)
+    assert overlap.splits().size == overlap.merges().size == 0
+
+
+def test_pair_context(pred: lmt.Label, truth: lmt.Label) -> None:
+    context = lmc.PairContext(pred, truth)
+    assert context.voxel_metrics() == lmm.voxel_metrics(pred, truth)
+    assert context.lfdr() == lmm.lfdr(pred, truth)
+    assert context.ltpr() == lmm.ltpr(pred, truth)
+    assert context.isbi15_score() == lmm.isbi15_score(pred, truth)
+    assert (context.pred_count, context.truth_count) == (3, 3)
+    assert context.overlap is context.overlap
+    assert context.truth_labels is context.truth_labels
+
+
+@pytest.mark.parametrize("shape", [(4, 5, 1), (1, 4, 5)])
+def test_pair_context_singleton_axis(shape: typing.Tuple[builtins.int, ...]) -> None:
+    data = np.zeros(shape)
+    data.flat[:7] = 1.0
+    affine = np.diag([2.0, 3.0, 4.0, 1.0])
+    image = mioi.Image(data, affine=affine)
+    context = lmc.PairContext.from_images(image, image)
+    assert context.pred.shape == (4, 5)
+    expected = lmv.SegmentationVolume(image).volume()
+    assert context.pred_volume == context.truth_volume == pytest.approx(expected)
+    kept = tuple(s for s, n in zip((2.0, 3.0, 4.0), shape) if n != 1)
+    assert context.surface_distances.assd() == 0.0
+    assert context.truth_spacing == kept
+
+
+def test_spacing_of_squeezed_image() -> None:
+    pred = np.zeros((1, 6, 6))
+    pred[0, 2:4, 1:3] = 1.0
+    truth = np.roll(pred, 1, axis=2)
+    affine = np.diag([2.0, 3.0, 4.0, 1.0])
+    pred_image = mioi.Image(pred, affine=affine)
+    truth_image = mioi.Image(truth, affine=affine)
+    with pytest.raises(ValueError):
+        lms.surface_distances(pred_image.squeeze(), truth_image.squeeze())
+    _, spacing = lms.squeeze(truth_image)
+    assert spacing == (3.0, 4.0)
+    context = lmc.PairContext.from_images(pred_image, truth_image)
+    assert context.surface_distances.hausdorff() == 4.0
+
+
+def test_evaluation_plan(pred: lmt.Label, truth: lmt.Label) -> None:
+    assert lmc.plan(["dice"]) == ["pred_mask", "truth_mask", "counts"]
+    assert lmc.plan(["ltpr"]) == [
+        "pred_mask",
+        "truth_mask",
+        "pred_labels",
+        "truth_labels",
+        "overlap",
+    ]
+    context = lmc.PairContext(pred, truth)
+    assert context.evaluate(["dice"]) == {"dice": lmm.dice(pred, truth)}
+    assert "counts" in vars(context)
+    assert "pred_labels" not in vars(context)
+    results = lmc.evaluate(pred, truth, ["isbi15_score", "truth_count"])
+    assert results == {"isbi15_score": lmm.isbi15_score(pred, truth), "truth_count": 3}
+    with pytest.raises(ValueError):
+        lmc.plan(["dice", "not_a_metric"])
+
+
 def test_avd(pred: lmt.Label, truth: lmt.Label) -> None:
     avd_score = lmm.avd(pred, truth)
     correct = 0.6
@@ -114,6 +308,28 @@ def test_corr(pred: lmt.Label, truth: lmt.Label) -> None:
     assert pytest.approx(corr_score, 1e-3) == correct
 
 
+def test_bootstrap() -> None:
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=200)
+    y = x + rng.normal(size=200)
+    values = np.stack([x, y], axis=1)
+    x_ci, _ = lmb.mean_confidence_intervals(values, n_replicates=2000)
+    assert x_ci.estimate == pytest.approx(x.mean())
+    assert x_ci.lower < x.mean() < x_ci.upper
+    # replicates match resampling with an explicit index matrix
+    indices = np.random.default_rng(0).integers(200, size=(2000, 200))
+    replicates = lmb.bootstrap_means(x, n_replicates=2000)[:, 0]
+    assert np.allclose(replicates, x[indices].mean(axis=1))
+    r_ci = lmb.correlation_confidence_interval(x, y, n_replicates=2000)
+    assert r_ci.estimate == pytest.approx(np.corrcoef(x, y)[0, 1])
+    assert r_ci.lower < r_ci.estimate < r_ci.upper
+    r = lmb.bootstrap_correlations(x, y, n_replicates=5)
+    assert r[0] == pytest.approx(np.corrcoef(x[indices[0]], y[indices[0]])[0, 1])
+    # resampling a single subject always draws all of its pairs
+    (one_subject,) = lmb.mean_confidence_intervals(x, groups=["a"] * 200)
+    assert one_subject.lower == pytest.approx(one_subject.upper)
+
+
 def test_isbi15_score(pred: lmt.Label, truth: lmt.Label) -> None:
     isbi15 = lmm.isbi15_score(pred, truth)
     correct = 0.6408730158730158
@@ -126,6 +342,88 @@ def test_segmentation_volume(pred_filename: pathlib.Path) -> None:
     assert vol == 4.0
 
 
-@pytest.mark.skip("Not implemented.")
+def test_lesion_volumes(pred_filename: pathlib.Path) -> None:
+    sv = lmv.SegmentationVolume.from_filename(pred_filename)
+    lesion_volumes = sv.lesion_volumes()
+    assert lesion_volumes.volumes.tolist() == [2.0, 1.0, 1.0]
+    assert (lesion_volumes.count, lesion_volumes.total) == (3, sv.volume())
+    counts, edges = lesion_volumes.histogram([0.0, 1.5, 10.0])
+    assert counts.tolist() == [2, 1]
+    sv.unit = lmv.UnitOfVolume.milliliter
+    assert sv.lesion_volumes().total == sv.volume()
+
+
+def test_streaming_volume(
+    pred_filename: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    assert lmv.count_positive_voxels(pred_filename, chunk_voxels=10) == (
+        4,
+        (1.0, 1.0, 1.0),
+    )
+    vol = lmv.streaming_volume(pred_filename, lmv.UnitOfVolume.milliliter)
+    assert vol == 4.0 / 1e3
+    # a (5, 5, 5) image in slabs of two 25-voxel planes (the last of one)
+    slabs = lmv._slabs((5, 5, 5), 50)
+    assert [(s.start, s.stop) for s in slabs] == [(0, 2), (2, 4), (4, 6)]
+    assert len(lmv._slabs((5, 5, 5), lmv.CHUNK_VOXELS)) == 1
+    assert len(lmv._slabs((256, 256, 256), lmv.CHUNK_VOXELS)) == 16
+    read: typing.List[builtins.slice] = []
+
+    def spy_slabs(*args: typing.Any) -> typing.List[builtins.slice]:
+        chunk = _slabs(*args)
+        read.extend(chunk)
+        return chunk
+
+    _slabs = lmv._slabs
+    monkeypatch.setattr(lmv, "_slabs", spy_slabs)
+    assert lmv.count_positive_voxels(pred_filename, chunk_voxels=50)[0] == 4
+    assert len(read) == 3
+    monkeypatch.undo()
+    assert lmv.streaming_volumes([pred_filename] * 3, max_workers=2) == [4.0] * 3
+
+
 def test_assd(pred: lmt.Label, truth: lmt.Label) -> None:
-    pass
+    assd_score = lmm.assd(pred, truth)
+    correct = 0.7903210787318556
+    assert assd_score == pytest.approx(correct, 1e-6)
+
+
+def test_hausdorff_distance(pred: lmt.Label, truth: lmt.Label) -> None:
+    hd = lmm.hausdorff_distance(pred, truth)
+    assert hd == pytest.approx(5**0.5, 1e-6)
+    assert lmm.hd95(pred, truth) <= hd
+    double_spaced = lmm.hausdorff_distance(pred, truth, spacing=(2.0, 2.0, 2.0))
+    assert double_spaced == pytest.approx(2 * hd, 1e-6)
+    assert np.isnan(lmm.hausdorff_distance(pred * 0, truth))
+
+
+def test_surface_dice(pred: lmt.Label, truth: lmt.Label) -> None:
+    tolerances = [0.0, 1.0, 1.5, 5.0]
+    surface_dice = lmm.surface_dice(pred, truth, tolerances)
+    correct = [6 / 14, 10 / 14, 12 / 14, 1.0]
+    assert surface_dice.tolist() == pytest.approx(correct)
+    context = lmc.PairContext(pred, truth)
+    assert context.surface_distances.surface_dice(tolerances).tolist() == (
+        surface_dice.tolist()
+    )
+
+
+def test_lesion_surface_distances(pred: lmt.Label, truth: lmt.Label) -> None:
+    context = lmc.PairContext(pred, truth)
+    distances = lms.lesion_surface_distances(context.pred_labels, context.truth_labels)
+    assert len(distances) == 3
+    assert [sd.is_empty for sd in distances] == [False, False, True]
+    assert distances[0].hausdorff() == pytest.approx(np.sqrt(2))
+    assert distances[1].assd() == 0.0
+    assert distances[2].hausdorff(95.0) != distances[2].hausdorff(95.0)  # NaN
+
+
+def test_hausdorff_distance_kdtree(pred: lmt.Label, truth: lmt.Label) -> None:
+    hd = lmm.hausdorff_distance(pred, truth, method="kdtree")
+    assert hd == pytest.approx(lmm.hausdorff_distance(pred, truth), 1e-6)
+    hd95_kdtree = lmm.hd95(pred, truth, method="kdtree")
+    assert hd95_kdtree == pytest.approx(lmm.hd95(pred, truth), 1e-6)
+    points = lms.surface_point_sets(pred, truth)
+    exact, (percentile,) = lms.hausdorff_from_points(*points, percentiles=[95.0])
+    assert exact == pytest.approx(hd, 1e-6)
+    assert percentile == pytest.approx(hd95_kdtree, 1e-6)